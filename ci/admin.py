@@ -1,5 +1,6 @@
 from django.contrib.admin import ModelAdmin, site
-from models import Project, BuildConfiguration, Build, Commit
+from models import Project, BuildConfiguration, Build, Commit, BranchStatus, HookEvent, \
+                   Blob, Artifact, TestTiming, BuildStats
 
 class ProjectAdmin(ModelAdmin):
     prepopulated_fields = {'slug': ['name']}
@@ -8,3 +9,9 @@ site.register(Project, ProjectAdmin)
 site.register(BuildConfiguration)
 site.register(Build)
 site.register(Commit)
+site.register(BranchStatus)
+site.register(HookEvent)
+site.register(Blob)
+site.register(Artifact)
+site.register(TestTiming)
+site.register(BuildStats)
@@ -0,0 +1,120 @@
+"""
+Build artifacts are stored content-addressed: each distinct file content is
+kept once as a `Blob` (gzipped if that makes it smaller), and `Artifact`s map
+the paths of a build's artifacts to blobs.
+"""
+import os
+import gzip
+import glob
+import hashlib
+import tempfile
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction, IntegrityError
+
+from ci.models import Artifact, Blob
+
+CHUNK_SIZE = 64 * 1024
+
+def iter_chunks(fobj):
+    return iter(lambda: fobj.read(CHUNK_SIZE), '')
+
+def find_artifacts(patterns, repo_path):
+    """
+    Yields the files matching any of the glob `patterns` (files inside
+    matching directories included) relative to `repo_path`.
+    """
+    root = os.path.realpath(repo_path)
+    seen = set()
+    for pattern in patterns:
+        for match in sorted(glob.glob(os.path.join(root, pattern))):
+            if os.path.isdir(match):
+                filenames = [os.path.join(dirpath, filename)
+                             for dirpath, _, filenames in os.walk(match)
+                             for filename in filenames]
+            else:
+                filenames = [match]
+            for filename in filenames:
+                path = os.path.relpath(filename, root)
+                # don't follow symlinks out of the checkout
+                if path not in seen and os.path.isfile(filename) and \
+                        os.path.realpath(filename).startswith(root + os.sep):
+                    seen.add(path)
+                    yield path
+
+def collect_artifacts(build, repo_path):
+    for path in find_artifacts(build.configuration.artifacts or [], repo_path):
+        store_artifact(build, path, os.path.join(repo_path, path))
+
+def get_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fobj:
+        for chunk in iter_chunks(fobj):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+@transaction.commit_on_success
+def store_artifact(build, path, filename):
+    sha1 = get_sha1(filename)
+    # The lock keeps `collect_garbage` from deleting the blob meanwhile.
+    blob = Blob.objects.select_for_update().filter(sha1=sha1)
+    blob = blob[0] if blob else create_blob(sha1, filename)
+    return Artifact.objects.create(build=build, path=path, blob=blob)
+
+def create_blob(sha1, filename):
+    blob = Blob(sha1=sha1, size=os.path.getsize(filename))
+    with tempfile.NamedTemporaryFile() as compressed:
+        if getattr(settings, 'CI_COMPRESS_ARTIFACTS', True):
+            with open(filename, 'rb') as fobj:
+                gzfile = gzip.GzipFile(fileobj=compressed, mode='wb')
+                for chunk in iter_chunks(fobj):
+                    gzfile.write(chunk)
+                gzfile.close()
+            # already compressed files are stored as they are
+            blob.compressed = compressed.tell() < blob.size
+        if blob.compressed:
+            compressed.seek(0)
+            blob.file.save('', File(compressed), save=False)
+        else:
+            with open(filename, 'rb') as fobj:
+                blob.file.save('', File(fobj), save=False)
+    savepoint = transaction.savepoint()
+    try:
+        blob.save()
+    except IntegrityError:
+        # The row lock in `store_artifact` doesn't keep concurrent builds from
+        # creating a blob that doesn't exist yet; use the one that won.
+        transaction.savepoint_rollback(savepoint)
+        blob.file.delete(save=False)
+        return Blob.objects.select_for_update().get(sha1=sha1)
+    transaction.savepoint_commit(savepoint)
+    return blob
+
+def open_blob(blob):
+    """ Returns a file object with the uncompressed contents of `blob` """
+    blob.file.open('rb')
+    if blob.compressed:
+        return gzip.GzipFile(fileobj=blob.file, mode='rb')
+    return blob.file
+
+@transaction.commit_on_success
+def collect_garbage(days=None):
+    """
+    Deletes the artifacts of builds that finished more than `days` days ago
+    (defaulting to ``CI_ARTIFACT_RETENTION``, keeping everything if that is
+    unset) and all blobs that aren't referenced anymore.  Returns the number
+    of deleted blobs.
+    """
+    if days is None:
+        days = getattr(settings, 'CI_ARTIFACT_RETENTION', None)
+    if days is not None:
+        Artifact.objects.filter(build__finished__lt=datetime.now() - timedelta(days=days)) \
+                        .delete()
+    blobs = list(Blob.objects.select_for_update()
+                             .exclude(pk__in=Artifact.objects.values('blob')))
+    for blob in blobs:
+        blob.file.delete(save=False)
+    Blob.objects.filter(pk__in=[blob.pk for blob in blobs]).delete()
+    return len(blobs)
@@ -0,0 +1,84 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from django.conf import settings
+
+from ci.dircache import DirectoryCache
+
+
+def get_build_cache():
+    root = getattr(settings, 'CI_CACHE_ROOT', None)
+    if root is None:
+        return None
+    return BuildCache(root, getattr(settings, 'CI_CACHE_MAX_SIZE', None))
+
+
+class BuildCache(DirectoryCache):
+    """
+    Directories (``BuildConfiguration.cache_dirs``) kept between builds of the
+    same configuration and matrix cell, keyed by the contents of the
+    configuration's ``cache_key_files`` in the checked-out tree.
+
+    Entries are written once and never modified; they are share-locked while
+    they are restored.
+    """
+    def get_key(self, build, repo_path):
+        config = build.configuration
+        key = hashlib.sha1(repr((sorted(config.cache_dirs), build.matrix_cell)))
+        for filename in sorted(config.cache_key_files or []):
+            key.update('\0%s\0' % filename)
+            try:
+                with open(os.path.join(repo_path, filename), 'rb') as fobj:
+                    for chunk in iter(lambda: fobj.read(64 * 1024), ''):
+                        key.update(chunk)
+            except IOError:
+                key.update('\0missing')
+        return '%s-%s' % (config.pk, key.hexdigest())
+
+    def get_entry_path(self, build, repo_path):
+        return os.path.join(self.root, self.get_key(build, repo_path))
+
+    def restore(self, build, repo_path):
+        """ Copies the cached directories into `repo_path`, if there are any """
+        path = self.get_entry_path(build, repo_path)
+        if not os.path.isdir(path):
+            return False
+        with self.lock(path, fcntl.LOCK_SH) as lockfile:
+            if not os.path.isdir(path):
+                # evicted meanwhile
+                return False
+            self.mark_used(lockfile)
+            for cache_dir in build.configuration.cache_dirs:
+                src = os.path.join(path, cache_dir)
+                if not os.path.isdir(src):
+                    continue
+                dest = os.path.join(repo_path, cache_dir)
+                if os.path.exists(dest):
+                    shutil.rmtree(dest)
+                shutil.copytree(src, dest, symlinks=True)
+        return True
+
+    def save(self, build, repo_path):
+        """ Stores the cache directories in `repo_path` unless already cached """
+        path = self.get_entry_path(build, repo_path)
+        if os.path.exists(path):
+            return
+        self.create_root()
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            for cache_dir in build.configuration.cache_dirs:
+                src = os.path.join(repo_path, cache_dir)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(tmp_path, cache_dir), symlinks=True)
+            open(path + '.lock', 'a').close()
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # saved by some other build meanwhile
+                pass
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=path)
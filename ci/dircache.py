@@ -0,0 +1,82 @@
+import os
+import errno
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+
+def get_tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class DirectoryCache(object):
+    """
+    Base class for caches of directories in `root` that are evicted least
+    recently used first once they take up more than `max_size` bytes.
+
+    Each entry has a ``.lock`` file next to it that is locked exclusively
+    while the entry is written or evicted and shared while it is read.  Its
+    mtime is the "last used" timestamp.  Entries whose names start with a dot
+    are considered incomplete.
+    """
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    def create_root(self):
+        try:
+            os.makedirs(self.root)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    @contextmanager
+    def lock(self, path, operation=fcntl.LOCK_EX):
+        with open(path + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, operation)
+            try:
+                yield lockfile
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def mark_used(self, lockfile):
+        os.utime(lockfile.name, None)
+
+    def get_entries(self):
+        """ Returns a list of ``(last_used, path)`` tuples, oldest first """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not name.startswith('.') and os.path.isdir(path):
+                try:
+                    entries.append((os.path.getmtime(path + '.lock'), path))
+                except OSError:
+                    entries.append((0, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        if self.max_size is None:
+            return
+        entries = [(path, get_tree_size(path)) for _, path in self.get_entries()]
+        total_size = sum(size for _, size in entries)
+        for path, size in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            # Lock files are never removed so that everyone always agrees on
+            # which inode to lock.
+            try:
+                with self.lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    shutil.rmtree(path)
+            except IOError:
+                # in use by some other worker
+                continue
+            total_size -= size
@@ -1,6 +1,10 @@
+import gzip
+import struct
+from tempfile import NamedTemporaryFile
+
 from django.db import models
 from django import forms
-from django.core.files.base import ContentFile
+from django.core.files.base import File, ContentFile
 
 
 class StringListField(models.CharField):
@@ -31,7 +35,71 @@ class NamedFieldFile(models.FileField.attr_class):
     def save_named(self, content, **kwargs):
         if isinstance(content, basestring):
             content = ContentFile(content)
-        return super(NamedFieldFile, self).save(self.field.filename, content, **kwargs)
+        super(NamedFieldFile, self).save(self.field.filename, content, **kwargs)
+        # FieldFile.save replaces us with our name on the model instance;
+        # put ourselves back so that callers can keep using this object.
+        setattr(self.instance, self.field.name, self)
+
+    def open_for_append(self):
+        # XXX #16964
+        if not self:
+            self.save_named('', save=False)
+        self.file.close()
+        self.open('ab')
+
+    def store_name(self):
+        """ Saves the file name to the database without saving the instance """
+        instance = self.instance
+        type(instance)._default_manager.filter(pk=instance.pk) \
+                                       .update(**{self.field.name: self.name})
+
+    @property
+    def compressed(self):
+        return self.name.endswith('.gz')
+
+    def compress(self):
+        """
+        Replaces the file with a gzipped copy.  Returns the sizes before and
+        after compression.
+        """
+        old_name, old_size = self.name, self.size
+        with NamedTemporaryFile() as tmp:
+            gzfile = gzip.GzipFile(self.field.filename, mode='wb', fileobj=tmp)
+            self.open('rb')
+            try:
+                for chunk in self.chunks():
+                    gzfile.write(chunk)
+            finally:
+                self.close()
+            gzfile.close()
+            tmp.seek(0)
+            self.name = self.storage.save(
+                self.field.generate_filename(self.instance, self.field.filename + '.gz'),
+                File(tmp))
+        self._file = None
+        # Readers of the uncompressed file reopen the file by the name in the
+        # database, hence update that before deleting the old file.
+        self.store_name()
+        self.storage.delete(old_name)
+        return old_size, self.size
+
+    def open_uncompressed(self):
+        """ Opens the file for reading, decompressing it on the fly """
+        self.open('rb')
+        if self.compressed:
+            return gzip.GzipFile(mode='rb', fileobj=self)
+        return self
+
+    def get_uncompressed_size(self):
+        if not self.compressed:
+            return self.size
+        # the gzip trailer holds the uncompressed size modulo 2**32
+        self.open('rb')
+        try:
+            self.seek(-4, 2)
+            return struct.unpack('<I', self.read(4))[0]
+        finally:
+            self.close()
 
 class NamedFileField(models.FileField):
     attr_class = NamedFieldFile
@@ -0,0 +1,76 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ci.models import Project, Commit, BranchStatus
+from ci.views import ProjectList
+
+BATCH_SIZE = 100
+
+class Command(BaseCommand):
+    help = "Seeds a throwaway test database and times the overview, " \
+           "project page and branch status queries."
+    option_list = BaseCommand.option_list + (
+        make_option('--commits', type='int', default=1000000),
+        make_option('--projects', type='int', default=20),
+        make_option('--branches', type='int', default=50,
+                    help="Number of branches per project"),
+        make_option('--repeat', type='int', default=10),
+    )
+
+    def handle(self, **options):
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.seed(options['projects'], options['branches'], options['commits'])
+            project = Project.objects.all()[0]
+            self.time("overview", options['repeat'], self.render_overview)
+            self.time("project page", options['repeat'],
+                      lambda: list(project.get_branch_commits()))
+            self.time("branch status refresh", options['repeat'],
+                      lambda: BranchStatus.refresh(project, 'branch-0'))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, nprojects, nbranches, ncommits):
+        projects = [Project.objects.create(name='p%d' % i, slug='p%d' % i, vcs_type='git')
+                    for i in xrange(nprojects)]
+        configuration = projects[0].configurations.create(name='tests')
+        branches = ['branch-%d' % i for i in xrange(nbranches)]
+        for start in xrange(0, ncommits, BATCH_SIZE):
+            commits = [Commit(project=projects[i % nprojects],
+                              branch=branches[i // nprojects % nbranches],
+                              vcs_id='%040x' % i, was_successful=bool(i % 3))
+                       for i in xrange(start, min(start + BATCH_SIZE, ncommits))]
+            Commit.objects.bulk_create(commits)
+            if start % 10000 == 0:
+                self.stdout.write("Seeded %d commits\n" % (start + len(commits)))
+
+        # Give each (project, branch)'s latest commit a finished build and
+        # one more commit with a pending build.
+        for project in projects:
+            for branch in branches:
+                commits = project.commits.filter(branch=branch)
+                for commit in commits[:1]:
+                    commit.builds.create(configuration=configuration,
+                                         was_successful=commit.was_successful,
+                                         started=commit.created,
+                                         finished=commit.created)
+                project.commits.create(branch=branch).builds.create(configuration=configuration)
+                BranchStatus.refresh(project, branch)
+
+    def render_overview(self):
+        view = ProjectList()
+        view.object_list = Project.objects.all()
+        return list(view.get_project_list())
+
+    def time(self, name, repeat, func):
+        timings = []
+        for i in xrange(repeat):
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+        timings.sort()
+        self.stdout.write("%-25s median %7.2f ms, max %7.2f ms\n" % (
+            name, timings[len(timings) // 2] * 1000, timings[-1] * 1000))
@@ -0,0 +1,19 @@
+from django.core.management.base import NoArgsCommand
+from ci.models import Build
+
+class Command(NoArgsCommand):
+    help = "Compresses the logs of finished builds that aren't compressed yet."
+
+    def handle_noargs(self, **options):
+        count = total_before = total_after = 0
+        builds = Build.objects.exclude(finished=None) \
+                              .exclude(stdout__endswith='.gz', stderr__endswith='.gz')
+        for build in builds.iterator():
+            for log in [build.stdout, build.stderr]:
+                if log and not log.compressed:
+                    before, after = log.compress()
+                    count += 1
+                    total_before += before
+                    total_after += after
+        self.stdout.write("Compressed %d logs from %d to %d bytes\n"
+                          % (count, total_before, total_after))
@@ -0,0 +1,14 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from ci.artifacts import collect_garbage
+
+class Command(NoArgsCommand):
+    help = "Deletes old artifacts and artifact files that aren't used anymore."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int',
+                    help="Delete the artifacts of builds older than this "
+                         "(default: CI_ARTIFACT_RETENTION)"),
+    )
+
+    def handle_noargs(self, days=None, **options):
+        self.stdout.write("Deleted %d files\n" % collect_garbage(days))
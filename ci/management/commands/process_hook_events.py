@@ -0,0 +1,8 @@
+from django.core.management.base import NoArgsCommand
+from ci.tasks import process_hook_events
+
+class Command(NoArgsCommand):
+    help = "Processes queued build hook events (see CI_ASYNC_HOOKS)."
+
+    def handle_noargs(self, **options):
+        process_hook_events()
@@ -0,0 +1,20 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from ci.retention import prune, get_retention_policy
+
+class Command(NoArgsCommand):
+    help = "Deletes old commits, builds, logs and artifacts (see CI_RETENTION)."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--keep-per-branch', type='int',
+                    help="Number of most recent commits to keep per branch"),
+        make_option('--max-age', type='int',
+                    help="Number of days after which commits may be deleted"),
+        make_option('--batch-size', type='int'),
+    )
+
+    def handle_noargs(self, keep_per_branch=None, max_age=None, batch_size=None, **options):
+        policy = get_retention_policy()
+        if keep_per_branch is not None or max_age is not None:
+            policy = {'keep_per_branch': keep_per_branch, 'max_age': max_age}
+        deleted = prune(batch_size=batch_size, **policy)
+        self.stdout.write("Deleted %d commits\n" % deleted)
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+from ci.models import Project, BranchStatus
+
+class Command(NoArgsCommand):
+    help = "Recomputes the denormalized status of every branch."
+
+    def handle_noargs(self, **options):
+        for project in Project.objects.all():
+            for branch in project.get_all_branches():
+                BranchStatus.refresh(project, branch)
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+from ci.tasks import release_stale_builds
+
+class Command(NoArgsCommand):
+    help = "Requeues builds that were queued but never started and fails builds " \
+           "whose worker seems to have died (see CI_QUEUE_TIMEOUT and CI_STALE_BUILD_TIMEOUT)."
+
+    def handle_noargs(self, **options):
+        requeued, failed = release_stale_builds()
+        self.stdout.write("Requeued %d builds, failed %d builds\n" % (requeued, failed))
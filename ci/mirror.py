@@ -0,0 +1,79 @@
+import os
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from subprocess import check_call
+
+from django.conf import settings
+
+from ci.dircache import DirectoryCache
+
+
+def get_mirror_cache():
+    root = getattr(settings, 'CI_MIRROR_ROOT', None)
+    if root is None:
+        return None
+    return MirrorCache(root, getattr(settings, 'CI_MIRROR_MAX_SIZE', None))
+
+
+class MirrorCache(DirectoryCache):
+    """
+    Per-project local mirrors of the upstream repositories.
+
+    Mirrors are fetched incrementally before each build and builds clone from
+    them (which hardlinks the object store) instead of from ``repo_uri``.
+    Mirrors are locked exclusively while they are created/updated and shared
+    while they are cloned.
+    """
+    def get_mirror_path(self, project):
+        key = hashlib.sha1(project.repo_uri.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.root, '%s-%s' % (project.id, key))
+
+    @contextmanager
+    def mirror(self, project):
+        """
+        Creates or updates the mirror for `project` and yields its path. The
+        mirror is share-locked for the duration of the block.
+        """
+        self.create_root()
+        path = self.get_mirror_path(project)
+        with self.lock(path) as lockfile:
+            if os.path.exists(path):
+                self.run(project.vcs_type, 'update', project.repo_uri, path)
+            else:
+                try:
+                    self.run(project.vcs_type, 'create', project.repo_uri, path)
+                except:
+                    shutil.rmtree(path, ignore_errors=True)
+                    raise
+            self.mark_used(lockfile)
+            # Downgrade so that concurrent builds may clone at the same time.
+            fcntl.flock(lockfile, fcntl.LOCK_SH)
+            yield path
+        self.evict(keep=path)
+
+    def clone(self, project, dest):
+        with self.mirror(project) as path:
+            self.run(project.vcs_type, 'clone', path, dest)
+
+    def run(self, vcs_type, action, src, dest):
+        check_call(getattr(self, 'get_%s_%s_cmd' % (vcs_type, action))(src, dest))
+
+    def get_git_create_cmd(self, src, dest):
+        return ['git', 'clone', '--mirror', '--quiet', '--', src, dest]
+
+    def get_git_update_cmd(self, src, dest):
+        return ['git', '--git-dir', dest, 'fetch', '--prune', '--quiet', 'origin']
+
+    def get_git_clone_cmd(self, src, dest):
+        return ['git', 'clone', '--quiet', '--', src, dest]
+
+    def get_hg_create_cmd(self, src, dest):
+        return ['hg', 'clone', '--noupdate', '--quiet', '--', src, dest]
+
+    def get_hg_update_cmd(self, src, dest):
+        return ['hg', '--repository', dest, 'pull', '--quiet', '--', src]
+
+    def get_hg_clone_cmd(self, src, dest):
+        return ['hg', 'clone', '--quiet', '--', src, dest]
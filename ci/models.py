@@ -1,15 +1,28 @@
 import os
+import re
+import itertools
+from fnmatch import fnmatch
 from collections import defaultdict
 
 import vcs
-from django.db import models
+from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.http import HttpRequest, QueryDict
+from django.db.models.query import prefetch_related_objects
 
 from ci.fields import StringListField, NamedFileField
 from ci.utils import make_choice_list
 from ci.plugins import BUILDERS
 
 VCS_CHOICES = make_choice_list(['git', 'hg'])
+COALESCE_CHOICES = [
+    ('', "never"),
+    ('pending', "supersede pending builds"),
+    ('all', "supersede pending and abort active builds"),
+]
+CANCEL_REASONS = make_choice_list(['superseded', 'cancelled', 'timed_out'])
 SHA1_LEN = 40
+ENV_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 def first_or_none(qs):
     try:
@@ -20,12 +33,19 @@ def first_or_none(qs):
 def make_build_log_filename(build, filename):
     return os.path.join('builds', str(build.id), filename)
 
+def make_blob_filename(blob, filename):
+    return os.path.join('blobs', blob.sha1[:2], blob.sha1[2:] + ('.gz' if blob.compressed else ''))
+
 class Project(models.Model):
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, unique=True)
     vcs_type = models.CharField('VCS type', choices=VCS_CHOICES, max_length=10)
     repo_uri = models.CharField('Repository URI', max_length=500)
     important_branches = StringListField(blank=True, null=True, max_length=500)
+    max_concurrent_builds = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum number of builds of this project to run at the same time"
+    )
 
     @property
     def builds(self):
@@ -43,6 +63,9 @@ class Project(models.Model):
 
     # XXX too many similar names
 
+    def get_build_priority(self, branch):
+        return int(branch in (self.important_branches or []))
+
     def get_branch_order(self):
         return self.important_branches or [self.get_vcs_backend().DEFAULT_BRANCH_NAME]
 
@@ -59,8 +82,10 @@ class Project(models.Model):
             except IndexError:
                 pass
 
-    def get_branches_ordered(self):
-        all_branches = list(self.get_all_branches())
+    def get_branches_ordered(self, all_branches=None):
+        if all_branches is None:
+            all_branches = self.get_all_branches()
+        all_branches = list(all_branches)
         for branch in self.get_branch_order():
             try:
                 all_branches.remove(branch)
@@ -71,24 +96,35 @@ class Project(models.Model):
             yield branch
 
 
-    def get_branch_commits(self):
-        for branch in self.get_branches_ordered():
-            commits = self.commits.filter(branch=branch)
-            latest = first_or_none(commits.exclude(was_successful=None))
-            latest_stable = first_or_none(commits.filter(was_successful=True))
-            unfinished = commits.order_by('created').exclude(vcs_id=None) \
-                                                    .filter(was_successful=None)
-            unfinished_builds = defaultdict(int)
-            for commit in unfinished:
-                for build in commit.builds.all():
-                    unfinished_builds[build.state] += 1
-            yield latest, latest_stable, unfinished_builds, unfinished
+    def get_branch_commits(self, queue_positions={}):
+        # A fixed number of queries, regardless of the number of branches
+        # and commits.  `queue_positions` maps branches to the queue position
+        # of their first pending build.
+        statuses = {status.branch: status for status in self.branch_statuses.select_related(
+            'latest_commit__project', 'latest_stable_commit__project')}
+        unfinished = defaultdict(list)
+        for commit in self.commits.order_by('created').exclude(vcs_id=None) \
+                                  .filter(was_successful=None).select_related('project'):
+            unfinished[commit.branch].append(commit)
+
+        commits = sum(unfinished.values(), [])
+        for status in statuses.itervalues():
+            commits.extend(filter(None, [status.latest_commit, status.latest_stable_commit]))
+        prefetch_related_objects(commits, ['builds__configuration'])
+
+        for branch in self.get_branches_ordered(statuses):
+            status = statuses[branch]
+            unfinished_builds = {'active': status.active_builds,
+                                 'pending': status.pending_builds,
+                                 'position': queue_positions.get(branch)}
+            yield status.latest_commit, status.latest_stable_commit, \
+                  unfinished_builds, unfinished[branch]
 
     def get_active_builds(self):
         return self.builds.exclude(started=None).filter(finished=None)
 
     def get_pending_builds(self):
-        return self.builds.filter(started=None)
+        return self.builds.filter(started=None, finished=None)
 
 
 class BuildConfiguration(models.Model):
@@ -97,6 +133,68 @@ class BuildConfiguration(models.Model):
     builder = models.CharField(choices=make_choice_list(BUILDERS), max_length=20)
     branches = StringListField(blank=True, null=True, max_length=500)
     parameters = models.TextField(null=True)
+    matrix = models.TextField(
+        blank=True, null=True,
+        help_text="One axis per line, e.g. \"PYTHON = 2.6, 2.7\".  A build is run for "
+                  "every combination, with the values in environment variables"
+    )
+    coalesce = models.CharField(
+        choices=COALESCE_CHOICES, max_length=10, blank=True,
+        help_text="What to do with builds of older commits on the same branch "
+                  "when a new commit arrives"
+    )
+    timeout = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum build duration in seconds"
+    )
+    idle_timeout = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum number of seconds without any build output"
+    )
+    paths = StringListField(
+        blank=True, null=True, max_length=500,
+        help_text="Glob patterns or directories (relative to the repository root); if given, "
+                  "builds of commits that don't change any matching file reuse the results "
+                  "of the branch's last successful commit"
+    )
+    reuse_results = models.BooleanField(
+        default=False,
+        help_text="Don't build revisions that have been built successfully before "
+                  "(e.g. on another branch)"
+    )
+    artifacts = StringListField(
+        blank=True, null=True, max_length=500,
+        help_text="Glob patterns (relative to the checkout) of files to keep after the build"
+    )
+    cache_dirs = StringListField(
+        blank=True, null=True, max_length=500,
+        help_text="Directories (relative to the checkout) to keep between builds"
+    )
+    cache_key_files = StringListField(
+        blank=True, null=True, max_length=500,
+        help_text="Files (e.g. requirements.txt) the cached directories depend on"
+    )
+    cpus = models.PositiveIntegerField('CPU slots', default=1)
+    memory = models.PositiveIntegerField(null=True, blank=True,
+                                         help_text="Required memory in megabytes")
+    locks = StringListField(
+        blank=True, null=True, max_length=500,
+        help_text="Names of resources (e.g. a shared database) no two builds may use at once"
+    )
+    max_concurrent_builds = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum number of builds of this configuration to run at the same time"
+    )
+    shards = models.PositiveIntegerField(
+        default=1,
+        help_text="Number of parts to split each build into, run as separate builds "
+                  "(possibly on different workers)"
+    )
+    test_report = models.CharField(
+        max_length=500, blank=True, null=True,
+        help_text="JUnit XML report (relative to the checkout) to take test durations from, "
+                  "used to balance shards"
+    )
 
     def __unicode__(self):
         return '%s: %s (%s)' % (self.project, self.name, self.builder)
@@ -104,6 +202,41 @@ class BuildConfiguration(models.Model):
     def should_build_branch(self, branch):
         return not self.branches or branch in self.branches
 
+    def watches_any(self, paths):
+        return any(fnmatch(path, pattern) or path.startswith(pattern.rstrip('/') + '/')
+                   for path in paths for pattern in self.paths)
+
+    def get_matrix_axes(self):
+        """ Returns the matrix as a list of ``(name, values)`` tuples """
+        axes = []
+        for line in (self.matrix or '').splitlines():
+            if '=' in line:
+                name, values = line.split('=', 1)
+                axes.append((name.strip(), [value.strip() for value in values.split(',')
+                                            if value.strip()]))
+        return axes
+
+    def get_matrix_cells(self):
+        """
+        Returns the matrix cells as ``"NAME=value, NAME=value"`` strings.
+        Values may contain spaces but no commas, hence this is unambiguous.
+        """
+        axes = [['%s=%s' % (name, value) for value in values]
+                for name, values in self.get_matrix_axes()]
+        return [', '.join(cell) for cell in itertools.product(*axes)]
+
+    def clean(self):
+        max_length = Build._meta.get_field('matrix_cell').max_length
+        axes = self.get_matrix_axes()
+        for name, values in axes:
+            if not ENV_NAME_RE.match(name):
+                raise ValidationError("Invalid matrix axis name %r" % name)
+        longest_cell = ', '.join('%s=%s' % (name, max(values or [''], key=len))
+                                 for name, values in axes)
+        if len(longest_cell) > max_length:
+            raise ValidationError("Matrix cells may not be longer than %d characters, "
+                                  "e.g. %r is too long" % (max_length, longest_cell))
+
 
 class Commit(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -135,28 +268,47 @@ class Commit(models.Model):
                                                    finished__isnull=True)
 
     def get_pending_builds_for_branch(self):
-        return self.get_builds_for_branch().filter(started__isnull=True)
+        return self.get_builds_for_branch().filter(started__isnull=True,
+                                                   finished__isnull=True)
 
 
 class Build(models.Model):
     configuration = models.ForeignKey(BuildConfiguration, related_name='builds')
     commit = models.ForeignKey(Commit, related_name='builds')
+    matrix_cell = models.CharField(max_length=200, blank=True, default='')
     started = models.DateTimeField(null=True, blank=True)
     finished = models.DateTimeField(null=True, blank=True)
     was_successful = models.NullBooleanField()
+    priority = models.IntegerField(default=0,
+                                   help_text="Builds with higher priority are run first")
+    queued = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, null=True, blank=True)
+    reused_from = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='reused_by')
+    cancel_reason = models.CharField(choices=CANCEL_REASONS, max_length=20,
+                                     null=True, blank=True)
+    # Sharded builds aren't executed themselves but collect their shards' results.
+    sharded = models.BooleanField(default=False)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='shards')
+    # numbered from 1; 0 for builds that aren't shards
+    shard = models.PositiveIntegerField(default=0)
+    shard_tests = models.TextField(blank=True, default='',
+                                   help_text="The tests assigned to the shard, one per line")
     stdout = NamedFileField('stdout.txt', upload_to=make_build_log_filename)
     stderr = NamedFileField('stderr.txt', upload_to=make_build_log_filename)
 
     class Meta:
-        unique_together = ['configuration', 'commit']
+        unique_together = ['configuration', 'commit', 'matrix_cell', 'shard']
 
     def save(self, *args, **kwargs):
         assert not (self.was_successful and not self.finished)
-        assert not (self.finished and not self.started)
+        assert not (self.finished and not self.started and not self.cancel_reason)
         return super(Build, self).save(*args, **kwargs)
 
     @property
     def state(self):
+        if self.cancel_reason:
+            return self.cancel_reason
         if self.finished:
             return ('failed', 'successful')[self.was_successful]
         else:
@@ -165,3 +317,136 @@ class Build(models.Model):
     @property
     def duration(self):
         return self.finished - self.started
+
+    def get_matrix_env(self):
+        return dict(item.split('=', 1) for item in self.matrix_cell.split(', ') if item)
+
+    def get_shard_env(self):
+        if self.parent_id is None:
+            return {}
+        return {'CI_SHARD_INDEX': str(self.shard - 1),
+                'CI_SHARD_COUNT': str(Build.objects.filter(parent=self.parent_id).count())}
+
+
+class BuildStats(models.Model):
+    """
+    Rolling statistics of the durations and queue wait times (in seconds) of a
+    configuration's latest builds, updated as builds finish; see `ci.stats`.
+    """
+    configuration = models.OneToOneField(BuildConfiguration, related_name='stats')
+    # the latest samples, comma-separated
+    durations = models.TextField(blank=True, default='')
+    wait_times = models.TextField(blank=True, default='')
+    duration_p50 = models.FloatField(null=True, blank=True)
+    duration_p90 = models.FloatField(null=True, blank=True)
+    duration_p99 = models.FloatField(null=True, blank=True)
+    wait_p50 = models.FloatField(null=True, blank=True)
+    wait_p90 = models.FloatField(null=True, blank=True)
+    wait_p99 = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'build stats'
+
+    def __unicode__(self):
+        return unicode(self.configuration_id)
+
+
+class TestTiming(models.Model):
+    """ The duration of a test in the latest build that ran it """
+    configuration = models.ForeignKey(BuildConfiguration, related_name='test_timings')
+    name = models.CharField(max_length=500)
+    duration = models.FloatField()
+
+    class Meta:
+        unique_together = ['configuration', 'name']
+
+    def __unicode__(self):
+        return '%s: %s' % (self.configuration_id, self.name)
+
+
+class Blob(models.Model):
+    """ Content-addressed artifact storage; see `ci.artifacts` """
+    sha1 = models.CharField(max_length=SHA1_LEN, unique=True)
+    size = models.BigIntegerField()
+    compressed = models.BooleanField(default=False)
+    file = models.FileField(upload_to=make_blob_filename)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.sha1
+
+
+class Artifact(models.Model):
+    build = models.ForeignKey(Build, related_name='artifacts')
+    path = models.CharField(max_length=500)
+    blob = models.ForeignKey(Blob, related_name='artifacts', on_delete=models.PROTECT)
+
+    class Meta:
+        unique_together = ['build', 'path']
+        ordering = ['path']
+
+    def __unicode__(self):
+        return '%s: %s' % (self.build_id, self.path)
+
+
+class BranchStatus(models.Model):
+    """
+    Denormalized per-branch state, kept up to date by ``refresh`` whenever a
+    commit or build of the branch changes.
+    """
+    project = models.ForeignKey(Project, related_name='branch_statuses')
+    branch = models.CharField(max_length=100)
+    latest_commit = models.ForeignKey(Commit, null=True, on_delete=models.SET_NULL,
+                                      related_name='+')
+    latest_stable_commit = models.ForeignKey(Commit, null=True, on_delete=models.SET_NULL,
+                                             related_name='+')
+    active_builds = models.PositiveIntegerField(default=0)
+    pending_builds = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['project', 'branch']
+        verbose_name_plural = 'branch statuses'
+
+    def __unicode__(self):
+        return '%s: %s' % (self.project, self.branch)
+
+    @classmethod
+    @transaction.commit_on_success
+    def refresh(cls, project, branch):
+        cls.objects.get_or_create(project=project, branch=branch)
+        status = cls.objects.select_for_update().get(project=project, branch=branch)
+        commits = project.commits.filter(branch=branch)
+        status.latest_commit = first_or_none(commits.exclude(was_successful=None))
+        status.latest_stable_commit = first_or_none(commits.filter(was_successful=True))
+        unfinished_builds = Build.objects.filter(commit__in=commits, finished=None,
+                                                 sharded=False)
+        status.active_builds = unfinished_builds.exclude(started=None).count()
+        status.pending_builds = unfinished_builds.filter(started=None).count()
+        status.save()
+        return status
+
+
+class HookEvent(models.Model):
+    """
+    A build hook request that has been accepted but not processed yet
+    (see ``CI_ASYNC_HOOKS``).  Only the parts of the request that build hooks
+    may look at are stored.
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    project = models.ForeignKey(Project, related_name='hook_events')
+    hook_type = models.CharField(max_length=50)
+    query_string = models.TextField(blank=True)
+    post_data = models.TextField(blank=True)
+    # set when a worker claims the event for processing
+    batch = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s: %s (%s)' % (self.project, self.hook_type, self.created)
+
+    def as_request(self):
+        request = HttpRequest()
+        request.GET = QueryDict(self.query_string)
+        request.POST = QueryDict(self.post_data)
+        return request
@@ -1,12 +1,22 @@
 import os
+import sys
+import time
+import signal
+import select
 import shutil
 import tempfile
 import traceback
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, CalledProcessError, check_call, check_output
+from multiprocessing.pool import ThreadPool
 
-from ci.utils import BuildFailed
+from django.conf import settings
+from django.db import connection
 
-__all__ = ['Plugin', 'BuildHook', 'Builder', 'CommandBasedBuilder']
+from ci.utils import BuildFailed, BuildCancelled, BuildTimedOut
+from ci.mirror import get_mirror_cache
+from ci.cache import get_build_cache
+
+__all__ = ['Plugin', 'BuildHook', 'Builder', 'CommandBasedBuilder', 'execute_batch']
 
 class Plugin(object):
     def get_builders(self):
@@ -22,51 +32,264 @@ class BuildHook(object):
     def get_changed_branches(self):
         raise NotImplementedError
 
+    def get_changed_revisions(self):
+        """
+        Returns ``(branch, vcs_id)`` tuples of the pushed branch heads.  If the
+        hook doesn't know the pushed revisions, `vcs_id` is None and the
+        branch's tip at build time is built.
+        """
+        return [(branch, None) for branch in self.get_changed_branches()]
+
+def set_commit_info(commit, changeset):
+    commit.vcs_id = changeset.raw_id
+    commit.short_message = changeset.message.splitlines()[0]
+    commit.save()
+
+def copy_tree(src, dest):
+    """ Copies `src` to `dest`, copy-on-write if the file system supports it """
+    try:
+        check_call(['cp', '-a', '--reflink=auto', src, dest])
+    except (OSError, CalledProcessError):
+        # not GNU cp
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(src, dest, symlinks=True)
+
+def execute_batch(builders, parallelism=1, callback=None):
+    """
+    Executes `builders`, whose builds belong to the same commit, `parallelism`
+    at a time.  The repository is cloned once and every build gets a copy of
+    that clone.  `callback(build)` is called as soon as a build is done.
+    """
+    callback = callback or (lambda build: None)
+    if len(builders) == 1:
+        builders[0].execute_build()
+        return callback(builders[0].build)
+    source_path = tempfile.mkdtemp()
+    os.rmdir(source_path)
+    try:
+        commit = builders[0].build.commit
+        try:
+            repo = builders[0].clone_repository(commit.project, source_path)
+            # resolve the revision once rather than in every build
+            if commit.vcs_id is None:
+                repo.workdir.checkout_branch(commit.branch)
+                set_commit_info(commit, repo.workdir.get_changeset())
+            elif not commit.short_message:
+                set_commit_info(commit, repo.get_changeset(commit.vcs_id))
+        except:
+            # What `Builder.execute_build` does for errors during a build
+            exc_info = sys.exc_info()
+            error = builders[0].format_exception()
+            for builder in builders:
+                builder.build.was_successful = False
+                builder.append_to_stderr(error)
+                if getattr(settings, 'CI_COMPRESS_LOGS', True):
+                    builder.compress_logs()
+                callback(builder.build)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for builder in builders:
+            builder.build.commit = commit
+            builder.source_path = source_path
+        if parallelism > 1:
+            pool = ThreadPool(min(parallelism, len(builders)))
+            try:
+                pool.map(lambda builder: execute_in_thread(builder, callback), builders)
+            finally:
+                pool.close()
+        else:
+            for builder in builders:
+                builder.execute_build()
+                callback(builder.build)
+    finally:
+        shutil.rmtree(source_path, ignore_errors=True)
+
+def execute_in_thread(builder, callback):
+    try:
+        builder.execute_build()
+        callback(builder.build)
+    finally:
+        # every thread has a database connection of its own
+        connection.close()
+
 class Builder(object):
-    def __init__(self, build):
+    def __init__(self, build, source_path=None):
         self.build = build
+        self.source_path = source_path
 
     def execute_build(self):
+        if self.reuse_result():
+            return
         try:
             self.setup_build()
-            self.run()
+            if self.reuse_result() or self.skip_unchanged():
+                return
+            self.restore_cache()
+            try:
+                self.run()
+            except BuildFailed:
+                self.collect_artifacts()
+                self.record_test_timings()
+                raise
             self.build.was_successful = True
+            self.collect_artifacts()
+            self.record_test_timings()
+            self.save_cache()
         except BuildFailed:
             self.build.was_successful = False
+        except BuildCancelled as exc:
+            # Timeouts (including those noticed by `release_stale_builds`) are
+            # failures, anything else has no result.
+            self.build.was_successful = False if exc.reason == 'timed_out' else None
+            self.build.cancel_reason = exc.reason
+            self.append_to_stderr("\n\n[django-ci: %s]\n" % exc)
         except:
             self.build.was_successful = False
-            # XXX #16964
-            if not self.build.stderr:
-                self.build.stderr.save_named('', save=False)
-            self.build.stderr.file.close()
-            self.build.stderr.open('a')
-            self.build.stderr.write(self.format_exception())
-            self.build.stderr.close()
-            self.build.stderr.open()
+            self.append_to_stderr(self.format_exception())
             raise
         finally:
             self.teardown_build()
+            if getattr(settings, 'CI_COMPRESS_LOGS', True):
+                self.compress_logs()
 
     def setup_build(self):
         self.repo_path = tempfile.mkdtemp()
         os.rmdir(self.repo_path)
-        Repository = self.build.configuration.project.get_vcs_backend()
-        self.repo = Repository(
-            self.repo_path,
-            create=True,
-            src_url=self.build.configuration.project.repo_uri,
-            update_after_clone=True
-        )
+        project = self.build.configuration.project
+        if self.source_path is None:
+            self.repo = self.clone_repository(project, self.repo_path)
+        else:
+            copy_tree(self.source_path, self.repo_path)
+            self.repo = project.get_vcs_backend()(self.repo_path)
         self.repo.workdir.checkout_branch(self.build.commit.branch)
         commit = self.build.commit
         if commit.vcs_id is None:
-            changeset = self.repo.workdir.get_changeset()
-            commit.vcs_id = changeset.raw_id
-            commit.short_message = changeset.message.splitlines()[0]
-            commit.save()
+            set_commit_info(commit, self.repo.workdir.get_changeset())
+        else:
+            self.checkout_revision(commit.vcs_id)
+            if not commit.short_message:
+                set_commit_info(commit, self.repo.get_changeset(commit.vcs_id))
+        if self.build.shard_tests:
+            with open(self.get_shard_tests_filename(), 'w') as fobj:
+                fobj.write(self.build.shard_tests.encode('utf-8') + '\n')
+
+    @staticmethod
+    def clone_repository(project, path):
+        Repository = project.get_vcs_backend()
+        mirror_cache = get_mirror_cache()
+        if mirror_cache is None:
+            return Repository(path, create=True, src_url=project.repo_uri,
+                              update_after_clone=True)
+        mirror_cache.clone(project, path)
+        return Repository(path)
+
+    def checkout_revision(self, vcs_id):
+        cmd = {'git': ['git', 'checkout', '--quiet', vcs_id],
+               'hg': ['hg', 'update', '--quiet', '--rev', vcs_id]}
+        check_call(cmd[self.build.configuration.project.vcs_type], cwd=self.repo_path)
+
+    def reuse_result(self):
+        """
+        Resolves the build with the result of an earlier successful build of
+        the same configuration, matrix cell and revision (of another commit),
+        if the configuration allows that.
+        """
+        build = self.build
+        if not build.configuration.reuse_results or not build.commit.vcs_id or build.parent_id:
+            return False
+        earlier = type(build).objects.filter(configuration=build.configuration_id,
+                                             matrix_cell=build.matrix_cell,
+                                             commit__vcs_id=build.commit.vcs_id,
+                                             was_successful=True, parent=None) \
+                                     .exclude(commit=build.commit_id).order_by('finished')[:1]
+        if not earlier:
+            return False
+        build.reused_from = earlier[0].reused_from or earlier[0]
+        build.was_successful = True
+        return True
+
+    def get_shard_tests_filename(self):
+        # outside the checkout so that it doesn't show up in there
+        return self.repo_path + '-shard-tests.txt'
+
+    def skip_unchanged(self):
+        """
+        Resolves the build with the result of the last successful commit of
+        the branch if the configuration watches ``paths`` none of which
+        changed since.
+        """
+        build = self.build
+        config = build.configuration
+        commit = build.commit
+        if not config.paths:
+            return False
+        base = type(commit).objects.filter(project=commit.project_id, branch=commit.branch,
+                                           was_successful=True) \
+                                   .exclude(vcs_id=None).exclude(pk=commit.pk)[:1]
+        if not base:
+            return False
+        original = type(build).objects.filter(commit=base[0], configuration=config.pk,
+                                              matrix_cell=build.matrix_cell,
+                                              was_successful=True, parent=None)[:1]
+        if not original:
+            return False
+        try:
+            changed = self.get_changed_files(base[0].vcs_id)
+        except CalledProcessError:
+            # e.g. history rewritten by a force push
+            return False
+        if config.watches_any(changed):
+            return False
+        build.reused_from = original[0].reused_from or original[0]
+        build.was_successful = True
+        return True
+
+    def get_changed_files(self, vcs_id):
+        """ Returns the paths of the files changed between `vcs_id` and the checkout """
+        # both the old and new name of renamed files
+        cmd = {'git': ['git', 'diff', '--name-only', '--no-renames', vcs_id, 'HEAD', '--'],
+               'hg': ['hg', 'status', '--no-status', '--rev', vcs_id, '--rev', '.']}
+        with open(os.devnull, 'w') as devnull:
+            return check_output(cmd[self.build.configuration.project.vcs_type],
+                                cwd=self.repo_path, stderr=devnull).splitlines()
+
+    def collect_artifacts(self):
+        # ci.models imports the plugins
+        from ci.artifacts import collect_artifacts
+        collect_artifacts(self.build, self.repo_path)
+
+    def record_test_timings(self):
+        from ci.sharding import record_test_timings
+        record_test_timings(self.build, self.repo_path)
+
+    def compress_logs(self):
+        for log in [self.build.stdout, self.build.stderr]:
+            if log and not log.compressed:
+                log.compress()
+
+    def restore_cache(self):
+        self.build_cache = get_build_cache()
+        if self.build_cache is not None and self.build.configuration.cache_dirs:
+            self.build_cache.restore(self.build, self.repo_path)
+
+    def save_cache(self):
+        if self.build_cache is not None and self.build.configuration.cache_dirs:
+            self.build_cache.save(self.build, self.repo_path)
+
+    def get_cancel_reason(self):
+        """ Returns why the build should be cancelled, if it should be """
+        return type(self.build).objects.filter(pk=self.build.pk) \
+                                       .values_list('cancel_reason', flat=True)[0]
 
     def teardown_build(self):
         shutil.rmtree(self.repo_path)
+        if os.path.exists(self.get_shard_tests_filename()):
+            os.remove(self.get_shard_tests_filename())
+
+    def append_to_stderr(self, data):
+        self.build.stderr.open_for_append()
+        self.build.stderr.write(data)
+        self.build.stderr.close()
+        self.build.stderr.open()
 
     def format_exception(self):
         return '\n\n' + '\n\n'.join([
@@ -79,16 +302,126 @@ class Builder(object):
         raise NotImplementedError
 
 
+class LogWriter(object):
+    """
+    Writes to a build's log file, truncating the log after `max_size` bytes
+    (if given).
+    """
+    truncation_marker = "\n\n[django-ci: log truncated after %d bytes]\n"
+
+    def __init__(self, fieldfile, max_size=None):
+        self.fieldfile = fieldfile
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+        fieldfile.save_named('', save=False)
+        # Store the file name right away so that the log can be tailed.
+        fieldfile.store_name()
+        fieldfile.open_for_append()
+
+    def write(self, data):
+        if self.truncated:
+            return
+        if self.max_size is not None and self.size + len(data) > self.max_size:
+            data = data[:self.max_size - self.size] + \
+                   self.truncation_marker % self.max_size
+            self.truncated = True
+        self.size += len(data)
+        self.fieldfile.write(data)
+
+    def close(self):
+        self.fieldfile.close()
+        self.fieldfile.open()
+
+
 class CommandBasedBuilder(Builder):
+    chunk_size = 64 * 1024
+    cancel_check_interval = 5
+    # seconds between checks whether a command without output has exited
+    poll_interval = 0.1
+    # seconds between SIGTERM and SIGKILL
+    kill_timeout = 10
+
     def run(self):
         cmd = self.get_cmd()
-        # XXX directly pipe into files
-        proc = Popen(cmd, cwd=self.repo_path, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = proc.communicate()
-        self.build.stderr.save_named(stderr, save=False)
-        self.build.stdout.save_named(stdout, save=False)
+        # Run the command in a process group of its own so that we can get
+        # rid of everything it spawned.
+        proc = Popen(cmd, cwd=self.repo_path, stdout=PIPE, stderr=PIPE,
+                     env=self.get_env(), preexec_fn=os.setsid)
+        try:
+            self.stream_output(proc)
+        finally:
+            # Also gets rid of background processes a finished command left behind.
+            self.kill(proc)
+            proc.wait()
         if proc.returncode:
             raise BuildFailed("Command %s returned with code %d" % (cmd, proc.returncode))
 
+    def stream_output(self, proc):
+        """
+        Copies the output of `proc` into the build's log files as it is
+        produced, holding at most `chunk_size` bytes per stream in memory.
+        Returns once `proc` has exited.  Raises `BuildCancelled` if the build
+        gets cancelled meanwhile and `BuildTimedOut` if the configuration's
+        timeouts are exceeded.
+        """
+        config = self.build.configuration
+        max_size = self.get_max_log_size()
+        logs = {proc.stdout.fileno(): LogWriter(self.build.stdout, max_size),
+                proc.stderr.fileno(): LogWriter(self.build.stderr, max_size)}
+        started = last_output = time.time()
+        next_cancel_check = started + self.cancel_check_interval
+        try:
+            while logs or proc.poll() is None:
+                if logs:
+                    readable, _, _ = select.select(list(logs), [], [],
+                                                   self.cancel_check_interval)
+                else:
+                    # The command closed its output but is still running.
+                    readable = []
+                    time.sleep(self.poll_interval)
+                for fd in readable:
+                    chunk = os.read(fd, self.chunk_size)
+                    if chunk:
+                        logs[fd].write(chunk)
+                        last_output = time.time()
+                    else:
+                        logs.pop(fd).close()
+                now = time.time()
+                if config.timeout and now - started > config.timeout:
+                    raise BuildTimedOut("build timed out after %d seconds" % config.timeout)
+                if config.idle_timeout and now - last_output > config.idle_timeout:
+                    raise BuildTimedOut("no output for %d seconds" % config.idle_timeout)
+                if now >= next_cancel_check:
+                    next_cancel_check = time.time() + self.cancel_check_interval
+                    cancel_reason = self.get_cancel_reason()
+                    if cancel_reason:
+                        raise BuildCancelled(cancel_reason)
+        finally:
+            for log in logs.values():
+                log.close()
+
+    def kill(self, proc):
+        """ Terminates the process group of `proc` """
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            deadline = time.time() + self.kill_timeout
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # process group is gone already
+            pass
+
+    def get_env(self):
+        env = dict(os.environ, **self.build.get_matrix_env())
+        env.update(self.build.get_shard_env())
+        if self.build.shard_tests:
+            env['CI_SHARD_TESTS'] = self.get_shard_tests_filename()
+        return env
+
+    def get_max_log_size(self):
+        return getattr(settings, 'CI_MAX_LOG_SIZE', None)
+
     def get_cmd(self):
         return self.cmd
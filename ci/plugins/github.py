@@ -7,8 +7,13 @@ class GitHubPlugin(Plugin):
 
 class GitHubPostReceiveHook(BuildHook):
     def get_changed_branches(self):
+        return [branch for branch, _ in self.get_changed_revisions()]
+
+    def get_changed_revisions(self):
         try:
             payload = json.loads(self.request.POST['payload'])
-            return [payload['ref'].replace('refs/heads/', '')]
+            if payload.get('deleted'):
+                return []
+            return [(payload['ref'].replace('refs/heads/', ''), payload.get('after'))]
         except (KeyError, ValueError):
             return []
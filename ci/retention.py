@@ -0,0 +1,91 @@
+"""
+Deletes old commits along with their builds, log files and artifacts
+according to ``CI_RETENTION``, a dict with the (optional) keys
+
+``keep_per_branch``
+    the number of most recent commits to keep on every branch
+``max_age``
+    the number of days after which commits may be deleted
+
+A commit is only deleted if it matches all the given criteria.  Commits of
+important branches, the latest and latest stable commit of each branch and
+commits with unfinished builds are always kept.
+"""
+import os
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from ci.models import Project, Commit, Build
+from ci.artifacts import collect_garbage
+
+
+def get_retention_policy():
+    return getattr(settings, 'CI_RETENTION', {})
+
+def get_prunable_commits(project, keep_per_branch=None, max_age=None):
+    """ Yields the ids of `project`'s prunable commits, branch by branch """
+    if keep_per_branch is None and max_age is None:
+        return
+    protected = set()
+    for status in project.branch_statuses.all():
+        protected.update([status.latest_commit_id, status.latest_stable_commit_id])
+    commits = project.commits.order_by().exclude(
+        pk__in=Build.objects.filter(commit__project=project, finished=None).values('commit'))
+    if max_age is not None:
+        commits = commits.filter(created__lt=datetime.now() - timedelta(days=max_age))
+
+    for branch in list(project.get_all_branches()):
+        if branch in (project.important_branches or []):
+            continue
+        keep = set(protected)
+        if keep_per_branch is not None:
+            keep.update(project.commits.filter(branch=branch).order_by('-created')
+                                       .values_list('pk', flat=True)[:keep_per_branch])
+        # don't keep the cursor open while the caller deletes commits
+        for pk in list(commits.filter(branch=branch).values_list('pk', flat=True)):
+            if pk not in keep:
+                yield pk
+
+@transaction.commit_on_success
+def delete_commits(commit_ids):
+    """ Deletes the given commits and returns their builds' log file names """
+    logs = Build.objects.filter(commit__in=commit_ids).values_list('stdout', 'stderr')
+    filenames = [filename for build_logs in logs for filename in build_logs if filename]
+    # cascades to builds and artifacts
+    Commit.objects.filter(pk__in=commit_ids).delete()
+    return filenames
+
+def delete_files(filenames, storage=default_storage):
+    for filename in filenames:
+        storage.delete(filename)
+        try:
+            os.rmdir(os.path.dirname(storage.path(filename)))
+        except (NotImplementedError, OSError):
+            # not a file system storage or other files left in the directory
+            pass
+
+def prune(keep_per_branch=None, max_age=None, batch_size=None):
+    """
+    Deletes prunable commits in batches of `batch_size` (one transaction per
+    batch, to keep locks short), their log files and all artifact blobs that
+    aren't used anymore.  Returns the number of deleted commits.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'CI_PRUNE_BATCH_SIZE', 500)
+    deleted = 0
+    for project in Project.objects.all():
+        batch = []
+        for pk in get_prunable_commits(project, keep_per_branch, max_age):
+            batch.append(pk)
+            if len(batch) == batch_size:
+                delete_files(delete_commits(batch))
+                deleted += len(batch)
+                batch = []
+        if batch:
+            delete_files(delete_commits(batch))
+            deleted += len(batch)
+    collect_garbage()
+    return deleted
@@ -0,0 +1,139 @@
+"""
+Builds of configurations with ``shards > 1`` are split into that many shard
+builds that are scheduled (and possibly placed on different workers) like
+any other build.  The parent build isn't executed; it gets the combined
+logs and result of its shards once all of them have finished.
+
+Shards are balanced using the test durations recorded from the
+configuration's ``test_report`` (JUnit XML) in earlier builds: known tests
+are assigned to shards up front, longest first, each to the shard with the
+least total duration so far.  Builders pass the assignment on to the build
+command in the environment:
+
+``CI_SHARD_INDEX``, ``CI_SHARD_COUNT``
+    the (zero-based) index of the shard and the number of shards
+``CI_SHARD_TESTS``
+    a file listing the tests assigned to the shard, one per line.  Tests
+    that aren't listed in any shard (because they haven't been run before)
+    are up to the command to split, e.g. by hashing their names modulo
+    ``CI_SHARD_COUNT``.
+"""
+import os
+import heapq
+from datetime import datetime
+from xml.etree import cElementTree as ElementTree
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+from ci.models import Build, TestTiming
+
+LOG_CHUNK_SIZE = 64 * 1024
+# stays below SQLite's limit of query parameters
+TIMINGS_BATCH_SIZE = 300
+
+def split_tests(timings, count):
+    """ Splits ``(name, duration)`` pairs into `count` lists of names """
+    shards = [(0, index, []) for index in range(count)]
+    for name, duration in sorted(timings, key=lambda timing: (-timing[1], timing[0])):
+        total, index, tests = heapq.heappop(shards)
+        tests.append(name)
+        heapq.heappush(shards, (total + duration, index, tests))
+    return [tests for _, _, tests in sorted(shards, key=lambda shard: shard[1])]
+
+def create_shards(builds):
+    """ Creates the shards of the sharded `builds`, which must have been saved """
+    shards = []
+    for build in builds:
+        config = build.configuration
+        timings = config.test_timings.values_list('name', 'duration')
+        for index, tests in enumerate(split_tests(timings, config.shards), 1):
+            shards.append(Build(commit=build.commit, configuration=config,
+                                priority=build.priority, matrix_cell=build.matrix_cell,
+                                parent=build, shard=index, shard_tests='\n'.join(tests)))
+    Build.objects.bulk_create(shards)
+
+def read_test_report(filename):
+    """ Yields ``(name, duration)`` for each test case in a JUnit XML report """
+    for _, element in ElementTree.iterparse(filename):
+        if element.tag == 'testcase':
+            name = element.get('name', '')
+            if element.get('classname'):
+                name = '%s.%s' % (element.get('classname'), name)
+            yield name, float(element.get('time') or 0)
+            element.clear()
+
+def record_test_timings(build, repo_path):
+    config = build.configuration
+    if not config.test_report:
+        return
+    try:
+        timings = dict(read_test_report(os.path.join(repo_path, config.test_report)))
+    except (IOError, SyntaxError, ValueError):
+        # no (valid) report, e.g. because the build failed early
+        return
+    save_test_timings(config, timings)
+
+@transaction.commit_on_success
+def save_test_timings(config, timings):
+    """ Replaces the recorded durations of the tests in `timings`, in batches """
+    names = sorted(timings)
+    batches = [names[start:start + TIMINGS_BATCH_SIZE]
+               for start in range(0, len(names), TIMINGS_BATCH_SIZE)]
+    for batch in batches:
+        config.test_timings.filter(name__in=batch).delete()
+    savepoint = transaction.savepoint()
+    try:
+        for batch in batches:
+            TestTiming.objects.bulk_create([
+                TestTiming(configuration=config, name=name, duration=timings[name])
+                for name in batch
+            ])
+    except IntegrityError:
+        # recorded by another build meanwhile; we'll get them next time
+        transaction.savepoint_rollback(savepoint)
+    else:
+        transaction.savepoint_commit(savepoint)
+
+def finish_sharded_build(parent_pk):
+    """
+    Finishes the sharded build `parent_pk` with the combined result and logs
+    of its shards if all of them have finished.  Returns whether it did.
+    Must be called inside a transaction.
+    """
+    parent = Build.objects.select_for_update().get(pk=parent_pk)
+    shards = list(parent.shards.order_by('shard'))
+    if parent.finished or any(shard.finished is None for shard in shards):
+        return False
+    results = [shard.was_successful for shard in shards]
+    parent.was_successful = False if False in results else \
+                            True if all(results) else None
+    if parent.was_successful is None and not parent.cancel_reason:
+        parent.cancel_reason = next(shard.cancel_reason for shard in shards
+                                    if shard.was_successful is None)
+    started = filter(None, [shard.started for shard in shards])
+    parent.started = min(started) if started else parent.started
+    parent.finished = datetime.now()
+    for log_name in ['stdout', 'stderr']:
+        combine_logs(getattr(parent, log_name), [getattr(shard, log_name) for shard in shards])
+    parent.save()
+    return True
+
+def combine_logs(log, shard_logs):
+    log.save_named('', save=False)
+    log.open_for_append()
+    try:
+        for index, shard_log in enumerate(shard_logs):
+            log.write("[django-ci: shard %d/%d]\n" % (index + 1, len(shard_logs)))
+            if shard_log:
+                fobj = shard_log.open_uncompressed()
+                try:
+                    for chunk in iter(lambda: fobj.read(LOG_CHUNK_SIZE), ''):
+                        log.write(chunk)
+                finally:
+                    shard_log.close()
+            log.write("\n")
+    finally:
+        log.close()
+    if getattr(settings, 'CI_COMPRESS_LOGS', True):
+        log.compress()
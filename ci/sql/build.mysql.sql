@@ -0,0 +1,4 @@
+-- Active/pending builds: BranchStatus.refresh, Project.get_active_builds,
+-- Project.get_pending_builds. (MySQL has no partial indexes.)
+CREATE INDEX ci_build_unfinished
+    ON ci_build (finished, started, commit_id);
@@ -0,0 +1,6 @@
+-- Indexes matching the Build access paths; run by syncdb when the table is
+-- created. For existing databases, apply with: manage.py sqlcustom ci
+
+-- Build results per commit: ProjectList, execute_build
+CREATE INDEX ci_build_commit_success
+    ON ci_build (commit_id, was_successful);
@@ -0,0 +1,5 @@
+-- Active/pending builds: BranchStatus.refresh, Project.get_active_builds,
+-- Project.get_pending_builds. Only a small fraction of all builds is
+-- unfinished, so a partial index stays tiny.
+CREATE INDEX ci_build_unfinished
+    ON ci_build (commit_id, started) WHERE finished IS NULL;
@@ -0,0 +1,11 @@
+-- Indexes matching the Commit access paths; run by syncdb when the table is
+-- created. For existing databases, apply with: manage.py sqlcustom ci
+
+-- Latest (stable) commit per branch: BranchStatus.refresh,
+-- Project.get_all_branches
+CREATE INDEX ci_commit_project_branch_success_created
+    ON ci_commit (project_id, branch, was_successful, created);
+
+-- Unfinished commits of a project: Project.get_branch_commits
+CREATE INDEX ci_commit_project_success_created
+    ON ci_commit (project_id, was_successful, created);
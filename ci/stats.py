@@ -0,0 +1,75 @@
+"""
+Rolling per-configuration build statistics: percentiles of the durations
+and queue wait times (from the creation of the commit to the start of the
+build) of the latest ``CI_STATS_WINDOW`` (default: 100) builds of each
+configuration.  They are updated incrementally as builds finish and used to
+estimate when unfinished builds are going to be done and, with
+``CI_SHORTEST_JOB_FIRST``, to run the builds expected to be quickest first.
+"""
+import math
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from ci.models import BuildStats
+
+PERCENTILES = [50, 90, 99]
+
+def percentile(values, p):
+    """ Returns the `p`-th percentile of the sorted `values` (nearest rank) """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def to_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def add_sample(samples, value, window):
+    samples = [float(sample) for sample in samples.split(',') if sample]
+    samples = (samples + [value])[-window:]
+    return ','.join('%.3f' % sample for sample in samples), sorted(samples)
+
+def record_build(build, commit):
+    """
+    Adds the finished `build` of `commit` to its configuration's statistics.
+    Builds that didn't run to the end (other than because of a timeout),
+    reused results and sharded builds are ignored.  Must be called inside a
+    transaction.
+    """
+    if not build.started or build.reused_from_id or build.sharded or \
+            build.cancel_reason not in [None, 'timed_out']:
+        return
+    window = getattr(settings, 'CI_STATS_WINDOW', 100)
+    BuildStats.objects.get_or_create(configuration_id=build.configuration_id)
+    stats = BuildStats.objects.select_for_update().get(configuration=build.configuration_id)
+    for field, prefix, value in [('durations', 'duration', build.duration),
+                                 ('wait_times', 'wait', build.started - commit.created)]:
+        samples, values = add_sample(getattr(stats, field), max(0, to_seconds(value)), window)
+        setattr(stats, field, samples)
+        for p in PERCENTILES:
+            setattr(stats, '%s_p%d' % (prefix, p), percentile(values, p))
+    stats.save()
+
+def get_stats(configurations):
+    return {stats.configuration_id: stats
+            for stats in BuildStats.objects.filter(configuration__in=configurations)}
+
+def get_duration_estimates():
+    """
+    Returns the median duration per configuration for shortest-job-first
+    scheduling, or an empty dict if that's disabled.
+    """
+    if not getattr(settings, 'CI_SHORTEST_JOB_FIRST', False):
+        return {}
+    return dict(BuildStats.objects.values_list('configuration', 'duration_p50'))
+
+def get_eta(build, commit, stats, now=None):
+    """
+    Returns when the unfinished `build` of `commit` is expected to finish
+    according to its configuration's `stats` (None if there aren't any).
+    """
+    if build.finished or stats is None or stats.duration_p50 is None:
+        return None
+    now = now or datetime.now()
+    duration = timedelta(seconds=stats.duration_p50)
+    if build.started:
+        return max(now, build.started + duration)
+    return max(now, commit.created + timedelta(seconds=stats.wait_p50)) + duration
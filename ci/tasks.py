@@ -1,21 +1,481 @@
-from datetime import datetime
+import heapq
+import logging
+from multiprocessing import cpu_count
+from uuid import uuid4
+from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict
+from celery import group
 from celery.task import task
-from ci.models import Build
-from ci.plugins import BUILDERS
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F
+from ci.models import Project, BuildConfiguration, Commit, Build, BranchStatus, \
+                      HookEvent
+from ci.plugins import BUILDERS, BUILD_HOOKS, execute_batch
+from ci.retention import prune, get_retention_policy, delete_files
+from ci.sharding import create_shards, finish_sharded_build
+from ci.stats import record_build, get_duration_estimates
+
+logger = logging.getLogger(__name__)
+
+@transaction.commit_on_success
+def create_builds(project, branches):
+    """
+    Creates a commit for each of `branches` and a build for each of the
+    commit's matching configurations (and the shards of sharded builds).
+    `branches` is a list of branch names or a mapping of branch names to the
+    pushed revisions (or None if unknown).  Branches without any matching
+    configuration and revisions that already have a commit on the same branch
+    don't get a commit.  Returns the new builds.
+    """
+    if not isinstance(branches, dict):
+        branches = OrderedDict.fromkeys(branches)
+    known_revisions = set()
+    if any(branches.values()):
+        known_revisions.update(project.commits.filter(
+            branch__in=branches.keys(), vcs_id__in=filter(None, branches.values())
+        ).values_list('branch', 'vcs_id'))
+    configurations = list(project.configurations.all())
+    commits = []
+    builds = []
+    for branch, vcs_id in branches.iteritems():
+        branch_configurations = [config for config in configurations
+                                 if config.should_build_branch(branch)]
+        if branch_configurations and (branch, vcs_id) not in known_revisions:
+            commit = project.commits.create(branch=branch, vcs_id=vcs_id)
+            commits.append(commit)
+            priority = project.get_build_priority(branch)
+            builds.extend(Build(commit=commit, configuration=config, priority=priority,
+                                matrix_cell=cell, sharded=config.shards > 1)
+                          for config in branch_configurations
+                          for cell in config.get_matrix_cells())
+    reuse_results(builds)
+    # bulk_create doesn't set primary keys, hence the extra query
+    Build.objects.bulk_create(builds)
+    if any(build.sharded and not build.finished for build in builds):
+        create_shards(Build.objects.filter(commit__in=commits, sharded=True, finished=None)
+                                   .select_related('commit', 'configuration'))
+    for commit_pk in set(build.commit_id for build in builds if build.reused_from_id):
+        update_commit_result(commit_pk)
+    if any(config.coalesce for config in configurations):
+        supersede_builds(commits)
+    return list(Build.objects.filter(commit__in=commits)
+                             .select_related('commit', 'configuration'))
+
+def reuse_results(builds):
+    """
+    Resolves those of the new, unsaved `builds` whose configuration reuses
+    results right away if their revision has been built successfully before.
+    """
+    builds = [build for build in builds
+              if build.configuration.reuse_results and build.commit.vcs_id]
+    if not builds:
+        return
+    earlier_builds = Build.objects.filter(
+        configuration__in=set(build.configuration_id for build in builds),
+        commit__vcs_id__in=set(build.commit.vcs_id for build in builds),
+        was_successful=True, parent=None
+    ).values_list('configuration', 'matrix_cell', 'commit__vcs_id', 'id', 'reused_from')
+    originals = {(config_pk, cell, vcs_id): reused_from or pk
+                 for config_pk, cell, vcs_id, pk, reused_from in earlier_builds}
+    now = datetime.now()
+    for build in builds:
+        original = originals.get((build.configuration_id, build.matrix_cell,
+                                  build.commit.vcs_id))
+        if original is not None:
+            build.reused_from_id = original
+            build.started = build.finished = now
+            build.was_successful = True
+
+def supersede_builds(new_commits):
+    """
+    Cancels the unfinished builds of older commits on the same branches
+    according to their configuration's ``coalesce`` policy.  Pending builds
+    are marked as finished right away; active builds are asked to abort.
+    Must be called inside a transaction.
+    """
+    now = datetime.now()
+    affected_commits = set()
+    parents = set()
+    for commit in new_commits:
+        older_builds = Build.objects.filter(commit__project=commit.project_id,
+                                            commit__branch=commit.branch,
+                                            commit__id__lt=commit.id,
+                                            finished=None)
+        pending = older_builds.filter(started=None,
+                                      configuration__coalesce__in=['pending', 'all'])
+        active = older_builds.exclude(started=None).filter(configuration__coalesce='all')
+        affected_commits.update(pending.values_list('commit', flat=True))
+        parents.update(pending.exclude(parent=None).values_list('parent', flat=True))
+        pending.update(finished=now, cancel_reason='superseded')
+        active.update(cancel_reason='superseded')
+    for parent_pk in parents:
+        finish_sharded_build(parent_pk)
+    for commit_pk in affected_commits:
+        update_commit_result(commit_pk)
+
+@transaction.commit_on_success
+def cancel_build(build):
+    """
+    Cancels an unfinished `build` (and its shards).  Pending builds are marked
+    as finished right away; active builds are aborted by their builder.
+    """
+    now = datetime.now()
+    unfinished = Build.objects.filter(Q(pk=build.pk) | Q(parent=build.pk), finished=None)
+    pending = unfinished.filter(started=None)
+    parents = set(pending.exclude(parent=None).values_list('parent', flat=True))
+    if pending.update(finished=now, cancel_reason='cancelled'):
+        # the parent of the last pending shards doesn't get finished by a builder
+        for parent_pk in parents:
+            finish_sharded_build(parent_pk)
+        update_commit_result(build.commit_id)
+    unfinished.update(cancel_reason='cancelled')
+
+def build_branches(project, branches):
+    builds = create_builds(project, branches)
+    for branch in set(build.commit.branch for build in builds):
+        BranchStatus.refresh(project, branch)
+    # Scheduling locks all projects and looks at all unfinished builds, which
+    # hooks shouldn't wait for.
+    schedule_builds.delay()
+
+def get_unfinished_builds():
+    return Build.objects.filter(finished=None, sharded=False).order_by().values(
+        'id', 'queued', 'started', 'priority', 'worker', 'commit', 'commit__project',
+        'commit__branch', 'configuration', 'configuration__builder')
+
+def get_build_queue(unfinished_builds, estimates={}):
+    """
+    Orders the pending builds in `unfinished_builds` (as returned by
+    `get_unfinished_builds`) by when they are going to be run.  Projects take
+    turns, the one with the fewest running builds first; within a project,
+    builds with higher priority, then (if `estimates` maps configurations to
+    expected durations) those expected to be quickest, then those of newer
+    commits go first.  Yields ``(running, build)`` tuples where `running` is
+    the number of builds of the project that are running or ahead in the
+    queue.
+    """
+    running = defaultdict(int)
+    pending = defaultdict(list)
+    for build in unfinished_builds:
+        if build['queued'] or build['started']:
+            running[build['commit__project']] += 1
+        else:
+            pending[build['commit__project']].append(build)
+
+    def make_turn(project, builds):
+        build = builds[0]
+        return running[project], -build['priority'], -build['commit'], project, builds
+
+    turns = []
+    for project, builds in pending.iteritems():
+        builds.sort(key=lambda build: (-build['priority'],
+                                       estimates.get(build['configuration']) or 0,
+                                       -build['commit'], build['id']))
+        turns.append(make_turn(project, builds))
+    heapq.heapify(turns)
+    while turns:
+        project, builds = heapq.heappop(turns)[-2:]
+        yield running[project], builds.pop(0)
+        running[project] += 1
+        if builds:
+            heapq.heappush(turns, make_turn(project, builds))
+
+def get_queue_positions(key):
+    """ Returns the queue position of the first pending build per `key(build)` """
+    positions = {}
+    queue = get_build_queue(get_unfinished_builds(), get_duration_estimates())
+    for position, (_, build) in enumerate(queue, 1):
+        positions.setdefault(key(build), position)
+    return positions
+
+class ResourcePool(object):
+    """
+    Bookkeeping of what running builds use: CPU slots and memory on each of
+    the workers declared in ``CI_WORKERS`` (``{name: {'cpus': n, 'memory':
+    megabytes}}``), locks, and the number of builds per configuration.
+    Without ``CI_WORKERS``, builds aren't placed on particular workers.
+    """
+    def __init__(self, workers):
+        self.free = {name: dict(resources) for name, resources in workers.iteritems()}
+        self.locks = set()
+        self.running = defaultdict(int)
+
+    def acquire(self, config, worker):
+        self.running[config.pk] += 1
+        self.locks.update(config.locks or [])
+        if worker in self.free:
+            self.free[worker]['cpus'] -= config.cpus
+            self.free[worker]['memory'] -= config.memory or 0
+
+    def can_run(self, config):
+        if config.max_concurrent_builds is not None and \
+                self.running[config.pk] >= config.max_concurrent_builds:
+            return False
+        if self.locks.intersection(config.locks or []):
+            return False
+        return not self.free or self.get_worker(config) is not None
+
+    def get_worker(self, config):
+        """ Returns the worker with the fewest free CPU slots `config` fits on """
+        fitting = [(free['cpus'], name) for name, free in self.free.iteritems()
+                   if free['cpus'] >= config.cpus and free['memory'] >= (config.memory or 0)]
+        if fitting:
+            return min(fitting)[1]
+
+
+def get_max_concurrent_builds():
+    """
+    Returns ``CI_MAX_CONCURRENT_BUILDS``, by default the total number of CPUs
+    of the ``CI_WORKERS`` or, without those, of this machine.  Builds beyond
+    the limit stay in the queue so that priorities and fair share apply to
+    them; None means no limit.
+    """
+    workers = getattr(settings, 'CI_WORKERS', {})
+    if workers:
+        default = sum(worker['cpus'] for worker in workers.itervalues())
+    else:
+        default = cpu_count()
+    return getattr(settings, 'CI_MAX_CONCURRENT_BUILDS', default)
+
+@transaction.commit_on_success
+def claim_builds():
+    """
+    Marks as many pending builds as queued as the `get_max_concurrent_builds`
+    and per-project limits and the builds' resource requirements allow, in
+    `get_build_queue` order (shortest job first with
+    ``CI_SHORTEST_JOB_FIRST``), and assigns them to workers.
+    """
+    # Serializes concurrent schedulers so that they don't exceed the limits.
+    limits = dict(Project.objects.select_for_update().order_by('pk')
+                                 .values_list('pk', 'max_concurrent_builds'))
+    max_builds = get_max_concurrent_builds()
+    unfinished_builds = list(get_unfinished_builds())
+    configurations = BuildConfiguration.objects.in_bulk(
+        set(build['configuration'] for build in unfinished_builds))
+    pool = ResourcePool(getattr(settings, 'CI_WORKERS', {}))
+    running = 0
+    for build in unfinished_builds:
+        if build['queued'] or build['started']:
+            running += 1
+            pool.acquire(configurations[build['configuration']], build['worker'])
+
+    claimed = []
+    estimates = get_duration_estimates()
+    for project_running, build in get_build_queue(unfinished_builds, estimates):
+        if max_builds is not None and running + len(claimed) >= max_builds:
+            break
+        limit = limits.get(build['commit__project'])
+        config = configurations[build['configuration']]
+        if (limit is None or project_running < limit) and pool.can_run(config):
+            build['worker'] = pool.get_worker(config)
+            pool.acquire(config, build['worker'])
+            claimed.append(build)
+
+    now = datetime.now()
+    by_worker = defaultdict(list)
+    for build in claimed:
+        by_worker[build['worker']].append(build['id'])
+    for worker, build_ids in by_worker.iteritems():
+        Build.objects.filter(pk__in=build_ids).update(queued=now, worker=worker)
+    return claimed
 
 @task
-def execute_build(build_id, builder):
-    build = Build.objects.get(id=build_id)
-    build.started = datetime.now()
-    build.save()
-    Builder = BUILDERS[builder]
+def schedule_builds():
+    """
+    Dispatches pending builds to the workers.  Builds placed on a particular
+    worker are sent to the Celery queue named after it.  The cells of a build
+    matrix placed on the same worker (or, with ``CI_BATCH_COMMIT_BUILDS``, all
+    of a commit's builds placed on the same worker) are sent as one task.
+    Called whenever builds are created or finish.
+    """
+    batch_commits = getattr(settings, 'CI_BATCH_COMMIT_BUILDS', False)
+    tasks = OrderedDict()
+    for build in claim_builds():
+        key = build['commit'], batch_commits or build['configuration'], build['worker']
+        tasks.setdefault(key, []).append(build['id'])
+    if tasks:
+        group(execute_builds.subtask((build_ids,), options={'queue': worker} if worker else {})
+              for (_, _, worker), build_ids in tasks.iteritems()).apply_async()
+
+@task
+def execute_build(build_id, builder=None):
+    execute_builds([build_id])
+
+@task
+def execute_builds(build_ids):
+    """
+    Executes builds of the same commit from a single clone,
+    ``CI_MATRIX_PARALLELISM`` (default: number of CPUs) at a time.
+    """
+    # Atomically claim the builds: they might have been superseded meanwhile.
+    build_ids = [build_id for build_id in build_ids
+                 if Build.objects.filter(id=build_id, started=None, finished=None)
+                                 .update(started=datetime.now())]
+    if not build_ids:
+        schedule_builds()
+        return
+    builds = list(Build.objects.filter(id__in=build_ids).order_by('id')
+                               .select_related('commit__project', 'configuration__project'))
+    Build.objects.filter(pk__in=[build.parent_id for build in builds if build.parent_id],
+                         started=None).update(started=datetime.now())
+    commit = builds[0].commit
+    BranchStatus.refresh(commit.project, commit.branch)
+    parallelism = getattr(settings, 'CI_MATRIX_PARALLELISM', None) or cpu_count()
+    finished = set()
+
+    def finish(build):
+        build.finished = datetime.now()
+        finish_build(build)
+        BranchStatus.refresh(commit.project, commit.branch)
+        finished.add(build.pk)
+
     try:
-        Builder(build).execute_build()
+        execute_batch([BUILDERS[build.configuration.builder](build) for build in builds],
+                      parallelism, finish)
     finally:
-        build.finished = datetime.now()
-        build.save()
-        # XXX run this in a SELECT ... FOR UPDATE transaction
-        builds = build.commit.builds
-        if not builds.filter(was_successful=None).exists():
-            build.commit.was_successful = not builds.filter(was_successful=False).exists()
-            build.commit.save()
+        for build in builds:
+            if build.pk not in finished:
+                if build.was_successful is None and not build.cancel_reason:
+                    # something went wrong outside of the builder
+                    build.was_successful = False
+                finish(build)
+        schedule_builds()
+
+@transaction.commit_on_success
+def finish_build(build):
+    """
+    Saves the finished `build`, adds it to the statistics, finishes its parent
+    if it was the parent's last unfinished shard and, if it was the last
+    unfinished build of its commit, sets the commit's result.  Does nothing
+    and returns False if the build has been finished already, e.g. by
+    `release_stale_builds` while it was still running.
+    """
+    if not Build.objects.filter(pk=build.pk, finished=None).update(finished=build.finished):
+        return False
+    build.save()
+    record_build(build, build.commit)
+    if build.parent_id:
+        finish_sharded_build(build.parent_id)
+    build.commit = update_commit_result(build.commit_id) or build.commit
+    return True
+
+def update_commit_result(commit_pk):
+    """
+    Sets the result of a commit all builds of which have finished.  A commit
+    is successful if at least one of its builds succeeded and none failed.
+    Commits with only superseded builds are deleted, along with their logs.
+    The commit row is locked while doing so, hence concurrently finishing
+    builds see each other's results.  Must be called inside a transaction.
+    """
+    commit = Commit.objects.select_for_update().get(pk=commit_pk)
+    if commit.builds.filter(finished=None).exists():
+        return commit
+    results = set(commit.builds.order_by().values_list('was_successful', 'cancel_reason')
+                                .distinct())
+    if results == set([(None, 'superseded')]):
+        # aborted active builds may have written logs
+        logs = commit.builds.values_list('stdout', 'stderr')
+        filenames = [filename for build_logs in logs for filename in build_logs if filename]
+        commit.delete()
+        delete_files(filenames)
+        return None
+    successes = [success for success, _ in results]
+    commit.was_successful = True in successes and False not in successes
+    commit.save()
+    return commit
+
+@task
+def release_stale_builds():
+    """
+    Returns builds that have been queued for more than ``CI_QUEUE_TIMEOUT``
+    seconds (default: an hour) without being started, e.g. because the task
+    message got lost, to the queue.  Fails builds that have been running for
+    more than their configuration's timeout plus ``CI_STALE_BUILD_GRACE``
+    seconds (default: 10 minutes) or, without timeout, ``CI_STALE_BUILD_TIMEOUT``
+    seconds (default: a day), e.g. because their worker died.  Either way, they
+    stop counting against the limits.  Meant to be run periodically.  Returns
+    the number of requeued and failed builds.
+    """
+    now = datetime.now()
+    queue_timeout = getattr(settings, 'CI_QUEUE_TIMEOUT', 60 * 60)
+    requeued = Build.objects.filter(
+        started=None, finished=None, queued__lt=now - timedelta(seconds=queue_timeout)
+    ).update(queued=None, worker=None)
+    grace = getattr(settings, 'CI_STALE_BUILD_GRACE', 10 * 60)
+    default_timeout = getattr(settings, 'CI_STALE_BUILD_TIMEOUT', 24 * 60 * 60)
+    failed = 0
+    for build in Build.objects.filter(finished=None, sharded=False).exclude(started=None) \
+                              .select_related('commit__project', 'configuration'):
+        timeout = build.configuration.timeout
+        timeout = timeout + grace if timeout else default_timeout
+        if build.started >= now - timedelta(seconds=timeout):
+            continue
+        # Builds still running (if any) are aborted by their builder.
+        build.finished = now
+        build.was_successful = False
+        build.cancel_reason = 'timed_out'
+        if finish_build(build):
+            BranchStatus.refresh(build.commit.project, build.commit.branch)
+            failed += 1
+    if requeued or failed:
+        schedule_builds()
+    return requeued, failed
+
+@task
+def prune_builds():
+    """ Applies the ``CI_RETENTION`` policy; meant to be run periodically """
+    return prune(**get_retention_policy())
+
+@task
+def process_hook_events():
+    """
+    Processes queued `HookEvent`s in batches of ``CI_HOOK_BATCH_SIZE`` until
+    there are none left.  Pushes to the same branch within a batch result in
+    a single commit.  Events claimed more than ``CI_HOOK_CLAIM_TIMEOUT``
+    seconds (default: 10 minutes) ago but not processed, e.g. because the
+    worker died or processing them failed, are claimed again, up to
+    ``CI_HOOK_MAX_ATTEMPTS`` times (default: 3).  Besides being triggered by
+    the hooks, meant to be run periodically in case a trigger got lost.
+    """
+    batch_size = getattr(settings, 'CI_HOOK_BATCH_SIZE', 100)
+    claim_timeout = getattr(settings, 'CI_HOOK_CLAIM_TIMEOUT', 10 * 60)
+    max_attempts = getattr(settings, 'CI_HOOK_MAX_ATTEMPTS', 3)
+    while True:
+        batch = uuid4().hex
+        now = datetime.now()
+        claimable = Q(batch=None) | Q(claimed__lt=now - timedelta(seconds=claim_timeout))
+        pks = list(HookEvent.objects.filter(claimable).order_by('id')
+                                    .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        # Events claimed by some other worker in the meantime are skipped.
+        HookEvent.objects.filter(claimable, pk__in=pks).update(
+            batch=batch, claimed=now, attempts=F('attempts') + 1)
+        events = OrderedDict()
+        for event in HookEvent.objects.filter(batch=batch).order_by('id') \
+                                      .select_related('project'):
+            events.setdefault(event.project, []).append(event)
+        for project, project_events in events.iteritems():
+            process_project_hook_events(project, project_events, max_attempts)
+
+def process_project_hook_events(project, events, max_attempts):
+    """
+    Builds the branches changed according to `project`'s `events` and deletes
+    the events.  If that fails, events that have been attempted
+    `max_attempts` times are deleted as well; the others are retried later.
+    """
+    pks = [event.pk for event in events]
+    try:
+        branches = OrderedDict()
+        for event in events:
+            if event.hook_type in BUILD_HOOKS:
+                hook = BUILD_HOOKS[event.hook_type](event.as_request())
+                branches.update(hook.get_changed_revisions())
+        if branches:
+            build_branches(project, branches)
+    except Exception:
+        logger.exception("Failed to process hook events %s of project %s", pks, project)
+        HookEvent.objects.filter(pk__in=pks, attempts__gte=max_attempts).delete()
+    else:
+        HookEvent.objects.filter(pk__in=pks).delete()
@@ -2,3 +2,10 @@ from .plugins import *
 from .views import *
 from .defaultplugins import *
 from .githubplugin import *
+from .mirror import *
+from .tasks import *
+from .cache import *
+from .artifacts import *
+from .retention import *
+from .sharding import *
+from .stats import *
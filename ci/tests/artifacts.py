@@ -0,0 +1,79 @@
+import os
+import gzip
+from datetime import datetime
+from StringIO import StringIO
+from django.conf import settings
+from ci.models import Build, Blob, Artifact
+from ci.artifacts import collect_garbage, open_blob, create_blob, get_sha1
+from ci.tests.utils import BuildDotShBuilder, default_branch
+from .plugins import BasePluginTest
+
+class ArtifactTests(BasePluginTest):
+    builder = BuildDotShBuilder
+    build_script = "mkdir -p reports/sub; echo -n $1 > reports/a.txt; " \
+                   "printf '%0100d' 0 > reports/sub/b.txt; echo -n x > dist.whl; " \
+                   "ln -s /etc/passwd reports/passwd"
+    commits = [{'message': "Added build script", 'added': {'build.sh': build_script}}]
+
+    def setUp(self):
+        super(ArtifactTests, self).setUp()
+        self.config.artifacts = ['reports', '*.whl', 'doesnotexist']
+        self.config.save()
+
+    def execute_build(self, arg=''):
+        commit = self.project.commits.create(branch=default_branch)
+        build = commit.builds.create(configuration=self.config, started=datetime.now())
+        builder = BuildDotShBuilder(build)
+        builder.cmd = builder.cmd + [arg]
+        builder.execute_build()
+        build.finished = datetime.now()
+        build.save()
+        return build
+
+    def get_artifacts(self, build):
+        return [(artifact.path, open_blob(artifact.blob).read())
+                for artifact in build.artifacts.all()]
+
+    def test_collect(self):
+        build = self.execute_build('1')
+        self.assertEqual(self.get_artifacts(build), [
+            ('dist.whl', 'x'), ('reports/a.txt', '1'), ('reports/sub/b.txt', '0' * 100)
+        ])
+        self.assertEqual(sorted(Blob.objects.values_list('size', 'compressed')),
+                         [(1, False), (1, False), (100, True)])
+
+    def test_deduplication(self):
+        self.execute_build('1')
+        self.execute_build('2')
+        self.assertEqual(Artifact.objects.count(), 6)
+        self.assertEqual(Blob.objects.count(), 4)
+
+    def test_concurrently_created_blob(self):
+        blob = Blob.objects.create(sha1=get_sha1(__file__), size=1)
+        blob_dir = os.path.join(settings.MEDIA_ROOT, 'blobs', blob.sha1[:2])
+        # as if another build had created the blob after `store_artifact` looked
+        self.assertEqual(create_blob(blob.sha1, __file__), blob)
+        self.assertEqual(os.listdir(blob_dir), [])
+
+    def test_download(self):
+        build = self.execute_build('1')
+        url = '/ci/p1/builds/%d/%d/artifacts/reports/sub/b.txt' % (build.commit_id, build.id)
+        response = self.client.get(url)
+        self.assertEqual(response.content, '0' * 100)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.content)).read(), '0' * 100)
+        self.assertEqual(self.client.get(url + 'x').status_code, 404)
+
+    def test_garbage_collection(self):
+        old_build = self.execute_build('1')
+        Build.objects.filter(pk=old_build.pk).update(finished=datetime(2000, 1, 1))
+        self.execute_build('2')
+        self.assertEqual(collect_garbage(), 0)
+        filename = Blob.objects.get(artifacts__path='reports/a.txt',
+                                    artifacts__build=old_build).file.path
+        self.assertEqual(collect_garbage(days=1), 1)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(Artifact.objects.count(), 3)
+        self.assertEqual(Blob.objects.count(), 3)
@@ -0,0 +1,62 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from django.test.utils import override_settings
+from ci.cache import get_build_cache
+from ci.tests.utils import BuildDotShBuilder, default_branch
+from .plugins import BasePluginTest
+
+class BuildCacheTests(BasePluginTest):
+    builder = BuildDotShBuilder
+    build_script = "test -e deps/installed && echo -n hit || echo -n miss; " \
+                   "mkdir -p deps; cat requirements.txt > deps/installed"
+    commits = [{'message': "Added build script",
+                'added': {'build.sh': build_script, 'requirements.txt': 'foo'}}]
+
+    def setUp(self):
+        self.cache_root = mkdtemp()
+        self.settings_override = override_settings(CI_CACHE_ROOT=self.cache_root)
+        self.settings_override.enable()
+        super(BuildCacheTests, self).setUp()
+        self.config.cache_dirs = ['deps']
+        self.config.cache_key_files = ['requirements.txt']
+        self.config.save()
+
+    def tearDown(self):
+        super(BuildCacheTests, self).tearDown()
+        self.settings_override.disable()
+        rmtree(self.cache_root)
+
+    def execute_build(self, matrix_cell=''):
+        commit = self.project.commits.create(branch=default_branch)
+        build = commit.builds.create(configuration=self.config, matrix_cell=matrix_cell)
+        BuildDotShBuilder(build).execute_build()
+        return build.stdout.open_uncompressed().read()
+
+    def test_cache(self):
+        self.assertEqual(self.execute_build(), 'miss')
+        self.assertEqual(self.execute_build(), 'hit')
+        self.commit({'changed': {'requirements.txt': 'bar'}})
+        self.assertEqual(self.execute_build(), 'miss')
+        self.assertEqual(len(get_build_cache().get_entries()), 2)
+
+    def test_cache_per_matrix_cell(self):
+        self.assertEqual(self.execute_build('PYTHON=2.6'), 'miss')
+        self.assertEqual(self.execute_build('PYTHON=2.7'), 'miss')
+        self.assertEqual(self.execute_build('PYTHON=2.6'), 'hit')
+
+    def test_failed_builds_are_not_cached(self):
+        self.commit({'changed': {'build.sh': self.build_script + '; exit 1'}})
+        self.assertEqual(self.execute_build(), 'miss')
+        self.assertEqual(self.execute_build(), 'miss')
+
+    def test_eviction(self):
+        with override_settings(CI_CACHE_MAX_SIZE=1):
+            self.execute_build()
+            old_entries = get_build_cache().get_entries()
+            self.commit({'changed': {'requirements.txt': 'bar'}})
+            self.execute_build()
+            entries = get_build_cache().get_entries()
+        self.assertEqual(len(entries), 1)
+        self.assertNotEqual(entries, old_entries)
+        self.assertFalse(os.path.exists(old_entries[0][1]))
@@ -12,5 +12,5 @@ class ShellBuilderTests(CommandBasedBuilderTests):
     def test_carriage_return_in_script(self):
         self.commit({'changed': {'build.sh': 'echo -n 1; \r\n echo -n 2'}})
         self.execute_build()
-        self.assertEqual(self.build.stderr.read(), '')
-        self.assertEqual(self.build.stdout.read(), '12')
+        self.assertEqual(self.build.stderr.open_uncompressed().read(), '')
+        self.assertEqual(self.build.stdout.open_uncompressed().read(), '12')
@@ -3,11 +3,19 @@ from django.test import TestCase
 from ci.plugins.github import GitHubPostReceiveHook
 
 class GitHubBuildHookTests(TestCase):
-    def _test_hook(self, ref, changed_branches):
+    def _test_hook(self, ref, changed_branches, **payload):
         class fake_request:
-            POST = {'payload': json.dumps({'ref': ref})}
+            POST = {'payload': json.dumps(dict(payload, ref=ref))}
         hook = GitHubPostReceiveHook(fake_request)
         self.assertEqual(hook.get_changed_branches(), changed_branches)
+        return hook
+
+    def test_revisions(self):
+        hook = self._test_hook('refs/heads/master', ['master'], after='abc')
+        self.assertEqual(hook.get_changed_revisions(), [('master', 'abc')])
+
+    def test_deleted_branch(self):
+        self._test_hook('refs/heads/master', [], after='0' * 40, deleted=True)
 
     def test_master(self):
         self._test_hook('refs/heads/master', ['master'])
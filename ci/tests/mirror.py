@@ -0,0 +1,61 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from django.test.utils import override_settings
+from ci.models import Project
+from ci.mirror import MirrorCache, get_mirror_cache
+from ci.tests.utils import BaseTestCase, default_branch
+from .plugins import BaseBuilderTests
+
+class MirroredBuilderTests(BaseBuilderTests):
+    def setUp(self):
+        self.mirror_root = mkdtemp()
+        self.settings_override = override_settings(CI_MIRROR_ROOT=self.mirror_root)
+        self.settings_override.enable()
+        super(MirroredBuilderTests, self).setUp()
+
+    def tearDown(self):
+        super(MirroredBuilderTests, self).tearDown()
+        self.settings_override.disable()
+        rmtree(self.mirror_root)
+
+    def test_mirror_is_updated(self):
+        self.execute_build()
+        cache = get_mirror_cache()
+        self.assertTrue(os.path.isdir(cache.get_mirror_path(self.project)))
+        self.commit({'message': "New commit"})
+        commit = self.project.commits.create(branch=default_branch)
+        self.build = commit.builds.create(configuration=self.config)
+        self.builder = self.__class__.builder(self.build)
+        self._test_build(success=True)
+        self.assertEqual(len(cache.get_entries()), 1)
+
+
+class MirrorEvictionTests(BaseTestCase):
+    def setUp(self):
+        super(MirrorEvictionTests, self).setUp()
+        self.mirror_root = mkdtemp()
+        self.other_project = Project.objects.create(
+            name='p2', slug='p2', vcs_type=self.project.vcs_type,
+            repo_uri=self.repo_path
+        )
+
+    def tearDown(self):
+        super(MirrorEvictionTests, self).tearDown()
+        rmtree(self.mirror_root)
+
+    def test_least_recently_used_mirror_is_evicted(self):
+        cache = MirrorCache(self.mirror_root, max_size=1)
+        with cache.mirror(self.project):
+            pass
+        with cache.mirror(self.other_project):
+            pass
+        self.assertFalse(os.path.exists(cache.get_mirror_path(self.project)))
+        self.assertTrue(os.path.exists(cache.get_mirror_path(self.other_project)))
+
+    def test_no_eviction_without_limit(self):
+        cache = MirrorCache(self.mirror_root)
+        for project in [self.project, self.other_project]:
+            with cache.mirror(project):
+                pass
+        self.assertEqual(len(cache.get_entries()), 2)
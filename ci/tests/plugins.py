@@ -1,5 +1,11 @@
+import os
+import time
+from datetime import datetime
+from django.test.utils import override_settings
+from django.core.exceptions import ValidationError
+from ci.models import Build
 from ci.utils import BuildFailed
-from ci.plugins.base import Builder
+from ci.plugins.base import Builder, execute_batch
 from ci.tests.utils import BaseTestCase, BuildDotShBuilder, default_branch
 
 class SimpleBuilder(Builder):
@@ -48,9 +54,10 @@ class BaseBuilderTests(BasePluginTest):
                 raise exc
         self.builder = BadBuilder(self.build)
         self.assertRaises(exc, self._test_build, success=False)
+        stderr = self.build.stderr.open_uncompressed().read()
         if stderr_hook:
-            stderr_hook()
-        stderr = self.build.stderr.read().strip().split('\n\n')
+            stderr = stderr_hook(stderr)
+        stderr = stderr.strip().split('\n\n')
         self.assertEqual(stderr[0], '=' * 79)
         self.assertEqual(stderr[1], "Exception in django-ci/builder")
         self.assertTrue(stderr[2].startswith("Traceback (most recent"))
@@ -76,20 +83,262 @@ class CommandBasedBuilderTests(BaseBuilderTests):
 
     def _test_build(self, success, stdout='output', stderr='error'):
         super(CommandBasedBuilderTests, self)._test_build(success)
-        self.assertEqual(self.build.stdout.read(), stdout)
-        self.assertEqual(self.build.stderr.read(), stderr)
+        self.assertEqual(self.build.stdout.open_uncompressed().read(), stdout)
+        self.assertEqual(self.build.stderr.open_uncompressed().read(), stderr)
 
     def _test_build_exception(self, exc):
-        def stderr_hook():
-            self.assertEqual(self.build.stderr.read(len('error')), 'error')
+        def stderr_hook(stderr):
+            self.assertEqual(stderr[:len('error')], 'error')
+            return stderr[len('error'):]
         super(CommandBasedBuilderTests, self)._test_build_exception(exc, stderr_hook)
 
     def break_build(self):
         self.commit({'message': "Broke the build", 'added': {'should_fail': ''}})
 
+    def test_logs_are_compressed(self):
+        self._test_build(success=True)
+        self.assertTrue(self.build.stdout.name.endswith('.gz'))
+        self.assertEqual(Build.objects.get(pk=self.build.pk).stderr.name,
+                         self.build.stderr.name)
+
+    @override_settings(CI_COMPRESS_LOGS=False)
+    def test_compression_disabled(self):
+        self._test_build(success=True)
+        self.assertFalse(self.build.stdout.name.endswith('.gz'))
+
+    def test_checkout_revision(self):
+        revision = self.repo.get_changeset().raw_id
+        self.commit({'message': "New commit", 'added': {'should_fail': ''}})
+        self.build.commit.vcs_id = revision
+        self.build.commit.save()
+        self.execute_build()
+        self.assertEqual(self.build.was_successful, True)
+        self.assertEqual(self.build.commit.short_message, "Added build script")
+
+    def test_reuse_result(self):
+        self.config.reuse_results = True
+        self.config.save()
+        self._test_build(success=True)
+        self.build.started = self.build.finished = datetime.now()
+        self.build.save()
+        commit = self.project.commits.create(branch='copy', vcs_id=self.build.commit.vcs_id)
+        build = commit.builds.create(configuration=self.config)
+        self.builder.__class__(build).execute_build()
+        self.assertEqual(build.was_successful, True)
+        self.assertEqual(build.reused_from, self.build)
+        self.assertFalse(build.stdout)
+
     def test_tons_of_output(self):
         # XXX use thread + timeout
         self.commit({'changed': {'build.sh': 'yes hello | head -n 100000'}})
         self.execute_build()
         # use raw 'assert' here to avoid spamming the console in case of a failure
-        assert self.build.stdout.read() ==  'hello\n'*100000
+        assert self.build.stdout.open_uncompressed().read() ==  'hello\n'*100000
+
+    @override_settings(CI_MAX_LOG_SIZE=10)
+    def test_log_size_limit(self):
+        self.commit({'changed': {'build.sh': 'yes hello 2>/dev/null | head -n 100000; echo -n err >&2'}})
+        self.execute_build()
+        self.assertEqual(self.build.stdout.open_uncompressed().read(), 'hello\nhell' +
+                         "\n\n[django-ci: log truncated after 10 bytes]\n")
+        self.assertEqual(self.build.stderr.open_uncompressed().read(), 'err')
+
+    def test_cancel_active_build(self):
+        self.commit({'changed': {'build.sh': 'echo -n started; sleep 30'}})
+        self.builder.cancel_check_interval = 0.1
+        Build.objects.filter(pk=self.build.pk).update(cancel_reason='superseded')
+        start = time.time()
+        self.execute_build()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.build.state, 'superseded')
+        self.assertEqual(self.build.stdout.open_uncompressed().read(), 'started')
+
+    def test_timed_out_by_release_stale_builds(self):
+        self.commit({'changed': {'build.sh': 'sleep 30'}})
+        self.builder.cancel_check_interval = 0.1
+        Build.objects.filter(pk=self.build.pk).update(cancel_reason='timed_out')
+        self.execute_build()
+        self.assertEqual(self.build.state, 'timed_out')
+        self.assertEqual(self.build.was_successful, False)
+
+    def _test_timeout(self, script, message, **config):
+        self.commit({'changed': {'build.sh': script}})
+        self.config.__dict__.update(config)
+        self.builder.cancel_check_interval = 0.1
+        self.builder.kill_timeout = 1
+        start = time.time()
+        self.execute_build()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.build.state, 'timed_out')
+        self.assertEqual(self.build.was_successful, False)
+        self.assertIn("[django-ci: %s]" % message, self.build.stderr.open_uncompressed().read())
+
+    def test_timeout(self):
+        self._test_timeout('while true; do echo .; sleep 0.1; done',
+                           "build timed out after 1 seconds", timeout=1)
+
+    def test_idle_timeout(self):
+        self._test_timeout('echo -n started; sleep 30',
+                           "no output for 1 seconds", idle_timeout=1)
+
+    def test_timeout_after_closing_output(self):
+        self._test_timeout('echo started; exec >/dev/null 2>&1; sleep 30',
+                           "build timed out after 1 seconds", timeout=1)
+
+    def test_background_processes_are_killed(self):
+        self.commit({'changed': {'build.sh': 'sleep 30 </dev/null >/dev/null 2>&1 & echo -n $!'}})
+        self.execute_build()
+        self.assertEqual(self.build.was_successful, True)
+        time.sleep(0.1)
+        status = '/proc/%s/status' % self.build.stdout.open_uncompressed().read()
+        if os.path.exists(status):
+            # zombie until reaped by init
+            self.assertIn('zombie', open(status).read())
+
+    def test_child_processes_are_killed(self):
+        self.commit({'changed': {'build.sh': '(sleep 30; echo survived) & wait'}})
+        self.config.timeout = 1
+        self.builder.cancel_check_interval = 0.1
+        start = time.time()
+        self.execute_build()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.build.stdout.open_uncompressed().read(), '')
+
+
+class MatrixTests(BaseTestCase):
+    commits = [{'message': "Added build script",
+                'added': {'build.sh': 'echo -n $PYTHON-$DB; test $DB != mysql'}}]
+
+    def setUp(self):
+        super(MatrixTests, self).setUp()
+        self.config = self.project.configurations.create(
+            builder='sh', matrix="PYTHON = 2.6, 2.7\nDB = sqlite,mysql\n\n")
+
+    def test_matrix_cells(self):
+        self.assertEqual(self.config.get_matrix_cells(), [
+            'PYTHON=2.6, DB=sqlite', 'PYTHON=2.6, DB=mysql',
+            'PYTHON=2.7, DB=sqlite', 'PYTHON=2.7, DB=mysql'
+        ])
+        self.config.matrix = ''
+        self.assertEqual(self.config.get_matrix_cells(), [''])
+
+    def test_values_with_spaces(self):
+        self.config.matrix = "ARGS = -x -v, -q\nDB = sqlite"
+        cell = self.config.get_matrix_cells()[0]
+        build = Build(configuration=self.config, matrix_cell=cell)
+        self.assertEqual(build.get_matrix_env(), {'ARGS': '-x -v', 'DB': 'sqlite'})
+
+    def test_clean(self):
+        self.config.clean()
+        for matrix in ["PY THON = 2.6", "PYTHON = 2.6, %s" % ('x' * 200)]:
+            self.config.matrix = matrix
+            self.assertRaises(ValidationError, self.config.clean)
+
+    def test_execute_matrix(self):
+        clones = []
+        class Builder(BuildDotShBuilder):
+            @staticmethod
+            def clone_repository(project, path):
+                clones.append(path)
+                return BuildDotShBuilder.clone_repository(project, path)
+        commit = self.project.commits.create(branch=default_branch)
+        builds = [commit.builds.create(configuration=self.config, matrix_cell=cell)
+                  for cell in self.config.get_matrix_cells()]
+        execute_batch([Builder(build) for build in builds])
+        self.assertEqual(len(clones), 1)
+        self.assertEqual([(build.stdout.open_uncompressed().read(), build.was_successful)
+                          for build in builds], [
+            ('2.6-sqlite', True), ('2.6-mysql', False),
+            ('2.7-sqlite', True), ('2.7-mysql', False)
+        ])
+        self.assertTrue(commit.vcs_id)
+
+    def test_execute_batch(self):
+        clones = []
+        finished = []
+        class Builder(BuildDotShBuilder):
+            @staticmethod
+            def clone_repository(project, path):
+                clones.append(path)
+                return BuildDotShBuilder.clone_repository(project, path)
+        other_config = self.project.configurations.create(builder='sh')
+        commit = self.project.commits.create(branch=default_branch)
+        builds = [commit.builds.create(configuration=self.config, matrix_cell='PYTHON=2.7, DB=sqlite'),
+                  commit.builds.create(configuration=other_config)]
+        execute_batch([Builder(build) for build in builds], callback=finished.append)
+        self.assertEqual(len(clones), 1)
+        self.assertEqual(finished, builds)
+        self.assertEqual([(build.stdout.open_uncompressed().read(), build.was_successful)
+                          for build in builds], [('2.7-sqlite', True), ('-', False)])
+
+    def test_reuse_result_per_cell(self):
+        self.config.reuse_results = True
+        self.config.save()
+        commit = self.project.commits.create(branch=default_branch,
+                                             vcs_id=self.repo.get_changeset().raw_id)
+        builds = [commit.builds.create(configuration=self.config, matrix_cell=cell,
+                                       started=datetime.now())
+                  for cell in self.config.get_matrix_cells()]
+        def finish(build):
+            build.finished = datetime.now()
+            build.save()
+        execute_batch([BuildDotShBuilder(build) for build in builds], callback=finish)
+        self.assertEqual([(build.was_successful, build.reused_from) for build in builds],
+                         [(True, None), (False, None), (True, None), (False, None)])
+
+    def test_execute_batch_clone_error(self):
+        self.project.repo_uri = '/does/not/exist'
+        self.project.save()
+        commit = self.project.commits.create(branch=default_branch)
+        builds = [commit.builds.create(configuration=self.config, matrix_cell=cell,
+                                       started=datetime.now())
+                  for cell in self.config.get_matrix_cells()]
+        finished = []
+        self.assertRaises(Exception, execute_batch,
+                          [BuildDotShBuilder(build) for build in builds], callback=finished.append)
+        self.assertEqual(finished, builds)
+        for build in builds:
+            build.finished = datetime.now()
+            self.assertEqual(build.state, 'failed')
+            self.assertIn("Exception in django-ci/builder",
+                          build.stderr.open_uncompressed().read())
+
+
+class PathFilterTests(BaseTestCase):
+    def setUp(self):
+        super(PathFilterTests, self).setUp()
+        for name, paths in [('docs', ['docs']), ('code', ['src/*.py']), ('all', None)]:
+            self.project.configurations.create(name=name, paths=paths)
+        self.base = self.project.commits.create(branch=default_branch, was_successful=True,
+                                                vcs_id=self.repo.get_changeset().raw_id)
+        now = datetime.now()
+        for config in self.project.configurations.all():
+            self.base.builds.create(configuration=config, started=now, finished=now,
+                                    was_successful=True)
+
+    def execute_builds(self, changes):
+        self.commit({'added': changes})
+        commit = self.project.commits.create(branch=default_branch,
+                                             vcs_id=self.repo.get_changeset().raw_id)
+        results = []
+        for config in self.project.configurations.order_by('name'):
+            build = commit.builds.create(configuration=config)
+            SimpleBuilder(build).execute_build()
+            results.append((config.name, build.reused_from and build.reused_from.commit))
+        return results
+
+    def test_skip_unchanged(self):
+        self.assertEqual(self.execute_builds({'docs/index.rst': 'x'}),
+                         [('all', None), ('code', self.base), ('docs', None)])
+        # still diffed against the last successful commit
+        self.assertEqual(self.execute_builds({'src/b/c.txt': 'x'}),
+                         [('all', None), ('code', self.base), ('docs', None)])
+
+    def test_glob(self):
+        self.assertEqual(self.execute_builds({'src/a.py': 'x', 'src/b/c.txt': 'x'}),
+                         [('all', None), ('code', None), ('docs', self.base)])
+
+    def test_unknown_base_revision(self):
+        self.project.commits.filter(pk=self.base.pk).update(vcs_id='0' * 40)
+        self.assertEqual(self.execute_builds({'docs/index.rst': 'x'}),
+                         [('all', None), ('code', None), ('docs', None)])
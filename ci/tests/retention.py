@@ -0,0 +1,49 @@
+import os
+from datetime import datetime, timedelta
+from django.test import TestCase
+from ci.models import Project, Commit, Build, BranchStatus
+from ci.retention import prune
+
+class PruneTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(slug='p1', important_branches=['master'])
+        self.config = self.project.configurations.create()
+        now = datetime.now()
+        # feature: stable, 4 x failed, unfinished; master: 3 x failed
+        for branch, results in [('feature', [True, False, False, False, False, None]),
+                                ('master', [False, False, False])]:
+            for i, result in enumerate(results):
+                commit = self.project.commits.create(branch=branch, vcs_id='%s%d' % (branch, i),
+                                                     was_successful=result)
+                Commit.objects.filter(pk=commit.pk).update(created=now - timedelta(days=10 - i, hours=12))
+                build = commit.builds.create(configuration=self.config, started=now)
+                if result is not None:
+                    build.finished = now
+                    build.was_successful = result
+                    build.stdout.save_named('output')
+            BranchStatus.refresh(self.project, branch)
+
+    def get_commits(self):
+        return list(Commit.objects.order_by('vcs_id').values_list('vcs_id', flat=True))
+
+    def test_no_policy(self):
+        self.assertEqual(prune(), 0)
+        self.assertEqual(len(self.get_commits()), 9)
+
+    def test_keep_per_branch(self):
+        filename = Build.objects.get(commit__vcs_id='feature1').stdout.path
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(prune(keep_per_branch=2, batch_size=2), 3)
+        self.assertEqual(self.get_commits(), ['feature0', 'feature4', 'feature5',
+                                              'master0', 'master1', 'master2'])
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(Build.objects.count(), 6)
+
+    def test_max_age(self):
+        self.assertEqual(prune(max_age=8), 2)
+        self.assertEqual(self.get_commits(), ['feature0', 'feature3', 'feature4', 'feature5',
+                                              'master0', 'master1', 'master2'])
+
+    def test_combined(self):
+        self.assertEqual(prune(keep_per_branch=4, max_age=7), 1)
+        self.assertEqual(prune(keep_per_branch=1, max_age=100), 0)
@@ -0,0 +1,35 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from django.conf import settings
+from django.db import connections
+from django.core.files.storage import default_storage
+from django.utils.functional import empty
+from djcelery.contrib.test_runner import CeleryTestSuiteRunner
+
+class TestSuiteRunner(CeleryTestSuiteRunner):
+    """
+    Keeps the build logs and artifacts written by the tests out of MEDIA_ROOT
+    and SQLite test databases on disk rather than in memory, so that builds
+    executed in threads see the same database.
+    """
+    def setup_test_environment(self, **kwargs):
+        super(TestSuiteRunner, self).setup_test_environment(**kwargs)
+        self.old_media_root = settings.MEDIA_ROOT
+        settings.MEDIA_ROOT = mkdtemp()
+        # the storage reads MEDIA_ROOT when it's set up
+        default_storage._wrapped = empty
+
+    def setup_databases(self, **kwargs):
+        for alias in connections:
+            settings_dict = connections[alias].settings_dict
+            if connections[alias].vendor == 'sqlite' and not settings_dict['TEST_NAME']:
+                settings_dict['TEST_NAME'] = os.path.join(settings.MEDIA_ROOT,
+                                                          'test-%s.sqlite' % alias)
+        return super(TestSuiteRunner, self).setup_databases(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super(TestSuiteRunner, self).teardown_test_environment(**kwargs)
+        rmtree(settings.MEDIA_ROOT)
+        settings.MEDIA_ROOT = self.old_media_root
+        default_storage._wrapped = empty
@@ -0,0 +1,117 @@
+from datetime import datetime
+from django.db import IntegrityError
+from django.test import TestCase
+from ci.models import Project, Build, TestTiming
+from ci.tasks import create_builds, finish_build, cancel_build, get_unfinished_builds
+from ci.sharding import split_tests, save_test_timings
+from ci.tests.utils import BuildDotShBuilder, default_branch
+from .plugins import BasePluginTest
+
+class SplitTestsTests(TestCase):
+    def test_balanced(self):
+        timings = [('a', 1), ('b', 7), ('c', 3), ('d', 4), ('e', 2), ('f', 1)]
+        self.assertEqual(split_tests(timings, 2), [['b', 'e'], ['d', 'c', 'a', 'f']])
+        self.assertEqual(split_tests([], 3), [[], [], []])
+
+
+class TestTimingsTests(TestCase):
+    def test_save(self):
+        config = Project.objects.create(slug='p1').configurations.create()
+        config.test_timings.create(name='old', duration=1)
+        config.test_timings.create(name='t0', duration=1)
+        timings = dict(('t%d' % i, i) for i in range(1000))
+        # per batch of 300 a SELECT, a DELETE (if there are known tests) and an INSERT
+        with self.assertNumQueries(4 + 1 + 4):
+            save_test_timings(config, timings)
+        self.assertEqual(config.test_timings.count(), 1001)
+        self.assertEqual(config.test_timings.get(name='t999').duration, 999)
+        self.assertEqual(config.test_timings.get(name='old').duration, 1)
+
+
+class ShardedBuildTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(slug='p1')
+        self.config = self.project.configurations.create(shards=2)
+        for name, duration in [('slow', 10), ('fast', 1), ('medium', 5)]:
+            self.config.test_timings.create(name=name, duration=duration)
+        self.parent, = Build.objects.filter(parent=None, pk__in=[
+            build.pk for build in create_builds(self.project, ['master'])])
+        self.shards = list(self.parent.shards.order_by('shard'))
+
+    def finish(self, build, success, output):
+        build.started = build.finished = datetime.now()
+        build.was_successful = success
+        build.stdout.save_named(output, save=False)
+        finish_build(build)
+
+    def test_create(self):
+        self.assertTrue(self.parent.sharded)
+        self.assertEqual([(shard.shard, shard.shard_tests) for shard in self.shards],
+                         [(1, 'slow'), (2, 'medium\nfast')])
+        self.assertEqual(sorted(build['id'] for build in get_unfinished_builds()),
+                         [shard.pk for shard in self.shards])
+
+    def test_finish(self):
+        self.finish(self.shards[1], True, 'one')
+        self.assertEqual(Build.objects.get(pk=self.parent.pk).finished, None)
+        self.finish(self.shards[0], False, 'zero')
+        parent = Build.objects.get(pk=self.parent.pk)
+        self.assertEqual(parent.was_successful, False)
+        self.assertEqual(parent.commit.was_successful, False)
+        self.assertEqual(parent.stdout.open_uncompressed().read(),
+                         "[django-ci: shard 1/2]\nzero\n[django-ci: shard 2/2]\none\n")
+
+    def test_cancel(self):
+        cancel_build(self.parent)
+        self.assertEqual(set(Build.objects.values_list('cancel_reason', flat=True)),
+                         set(['cancelled']))
+        self.assertEqual(Build.objects.filter(finished=None).count(), 0)
+
+    def test_unique(self):
+        with self.assertRaises(IntegrityError):
+            Build.objects.create(configuration=self.config, commit=self.parent.commit)
+
+    def start_parent(self):
+        # as done by `execute_builds` for the first shard
+        Build.objects.filter(pk=self.parent.pk).update(started=datetime.now())
+
+    def test_cancel_last_shard(self):
+        self.start_parent()
+        self.finish(self.shards[0], True, 'zero')
+        cancel_build(self.parent)
+        parent = Build.objects.get(pk=self.parent.pk)
+        self.assertNotEqual(parent.finished, None)
+        self.assertEqual((parent.was_successful, parent.cancel_reason), (None, 'cancelled'))
+        self.assertEqual(parent.commit.was_successful, True)
+
+    def test_supersede_last_shard(self):
+        self.config.coalesce = 'pending'
+        self.config.save()
+        self.start_parent()
+        self.finish(self.shards[0], True, 'zero')
+        create_builds(self.project, ['master'])
+        parent = Build.objects.get(pk=self.parent.pk)
+        self.assertNotEqual(parent.finished, None)
+        self.assertEqual((parent.was_successful, parent.cancel_reason), (None, 'superseded'))
+        self.assertEqual(parent.commit.was_successful, True)
+
+
+class ShardBuilderTests(BasePluginTest):
+    builder = BuildDotShBuilder
+    commits = [{'message': "Added build script", 'added': {'build.sh':
+        'echo -n $CI_SHARD_INDEX/$CI_SHARD_COUNT $(cat $CI_SHARD_TESTS); '
+        'echo \'<testsuite><testcase classname="a" name="b" time="1.5"/></testsuite>\' > junit.xml'
+    }}]
+
+    def test_shard(self):
+        self.config.shards = 2
+        self.config.test_report = 'junit.xml'
+        self.config.save()
+        self.config.test_timings.create(name='a.b', duration=1)
+        self.config.test_timings.create(name='c.d', duration=2)
+        create_builds(self.project, [default_branch])
+        shard = Build.objects.get(parent__sharded=True, shard=2)
+        BuildDotShBuilder(shard).execute_build()
+        self.assertEqual(shard.stdout.open_uncompressed().read(), '1/2 a.b')
+        self.assertEqual(list(TestTiming.objects.order_by('name').values_list('name', 'duration')),
+                         [('a.b', 1.5), ('c.d', 2)])
@@ -0,0 +1,86 @@
+import json
+from datetime import datetime, timedelta
+from django.test import TestCase
+from django.test.utils import override_settings
+from ci.models import Project, BuildStats
+from ci.tasks import finish_build, get_build_queue, get_unfinished_builds
+from ci.stats import get_eta
+
+class BuildStatsTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(slug='p1')
+        self.config = self.project.configurations.create(name='tests')
+        self.commit = self.project.commits.create(branch='master')
+        self.created = self.commit.created
+
+    def finish(self, duration, wait=0, **kwargs):
+        started = self.created + timedelta(seconds=wait)
+        build = self.commit.builds.create(configuration=self.config,
+                                          matrix_cell=str(self.commit.builds.count()),
+                                          started=started, **kwargs)
+        build.finished = started + timedelta(seconds=duration)
+        finish_build(build)
+        return build
+
+    def get_stats(self):
+        stats = BuildStats.objects.get(configuration=self.config)
+        return stats.duration_p50, stats.duration_p90, stats.duration_p99, stats.wait_p50
+
+    def test_percentiles(self):
+        for duration in range(1, 11):
+            self.finish(duration * 10, wait=duration)
+        self.assertEqual(self.get_stats(), (50, 90, 100, 5))
+
+    def test_window(self):
+        with override_settings(CI_STATS_WINDOW=3):
+            for duration in [1000, 10, 20, 30]:
+                self.finish(duration)
+        self.assertEqual(self.get_stats(), (20, 30, 30, 0))
+
+    def test_ignored(self):
+        self.finish(10)
+        self.finish(1000, cancel_reason='cancelled')
+        self.finish(1000, reused_from=self.finish(10))
+        self.assertEqual(self.get_stats(), (10, 10, 10, 0))
+
+    def test_eta(self):
+        self.finish(60, wait=30)
+        stats = BuildStats.objects.get()
+        now = self.created + timedelta(seconds=10)
+        active = self.commit.builds.create(configuration=self.config, matrix_cell='active',
+                                           started=now)
+        pending = self.commit.builds.create(configuration=self.config, matrix_cell='pending')
+        self.assertEqual(get_eta(active, self.commit, stats, now), now + timedelta(seconds=60))
+        self.assertEqual(get_eta(pending, self.commit, stats, now),
+                         self.created + timedelta(seconds=90))
+        self.assertEqual(get_eta(pending, self.commit, stats, now + timedelta(seconds=100)),
+                         now + timedelta(seconds=160))
+        self.assertEqual(get_eta(pending, self.commit, None, now), None)
+
+    def test_shortest_job_first(self):
+        slow = self.project.configurations.create(name='slow')
+        slow.builds.create(commit=self.commit, started=datetime.now())
+        for config in [slow, self.config]:
+            BuildStats.objects.create(configuration=config,
+                                      duration_p50=100 if config == slow else 10)
+        commit = self.project.commits.create(branch='master')
+        slow.builds.create(commit=commit)
+        self.config.builds.create(commit=commit)
+        queue = lambda estimates: [build['configuration'] for _, build in
+                                   get_build_queue(get_unfinished_builds(), estimates)]
+        self.assertEqual(queue({}), [slow.pk, self.config.pk])
+        self.assertEqual(queue({slow.pk: 100, self.config.pk: 10}), [self.config.pk, slow.pk])
+
+    def test_json(self):
+        self.finish(10, wait=5)
+        self.project.configurations.create(name='docs')
+        response = self.client.get('/ci/p1/stats.json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), [
+            {'configuration': 'docs', 'builds': 0,
+             'duration': {'p50': None, 'p90': None, 'p99': None},
+             'wait': {'p50': None, 'p90': None, 'p99': None}},
+            {'configuration': 'tests', 'builds': 1,
+             'duration': {'p50': 10, 'p90': 10, 'p99': 10},
+             'wait': {'p50': 5, 'p90': 5, 'p99': 5}},
+        ])
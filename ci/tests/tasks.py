@@ -0,0 +1,316 @@
+from datetime import datetime, timedelta
+from multiprocessing import cpu_count
+from collections import OrderedDict
+from django.test import TestCase
+from django.core.files.storage import default_storage
+from django.test.utils import override_settings
+from ci.models import Project, Commit, Build, BuildStats
+from ci.plugins import BUILDERS
+from ci.tasks import create_builds, finish_build, execute_build, claim_builds, \
+                     get_build_queue, get_unfinished_builds, release_stale_builds, \
+                     get_max_concurrent_builds, build_branches
+from ci.tests.utils import BaseTransactionTestCase, BuildDotShBuilder, default_branch
+
+class FinishBuildTests(TestCase):
+    def setUp(self):
+        project = Project.objects.create(slug='p1')
+        self.commit = project.commits.create(branch='master', vcs_id='c1')
+        self.builds = [self.commit.builds.create(configuration=project.configurations.create(),
+                                                 started=datetime.now())
+                       for i in range(3)]
+
+    def finish(self, build, success):
+        build.was_successful = success
+        build.finished = datetime.now()
+        finish_build(build)
+        return build.commit.was_successful
+
+    def test_successful(self):
+        self.assertEqual(self.finish(self.builds[0], True), None)
+        self.assertEqual(self.finish(self.builds[1], True), None)
+        self.assertEqual(self.finish(self.builds[2], True), True)
+
+    def test_failed(self):
+        self.assertEqual(self.finish(self.builds[2], True), None)
+        self.assertEqual(self.finish(self.builds[0], False), None)
+        self.assertEqual(self.finish(self.builds[1], True), False)
+        self.assertEqual(Commit.objects.get().was_successful, False)
+
+    def test_finished_already(self):
+        self.finish(self.builds[0], False)
+        build = Build.objects.get(pk=self.builds[0].pk)
+        build.was_successful = None
+        build.cancel_reason = 'timed_out'
+        self.assertFalse(finish_build(build))
+        self.assertEqual(Build.objects.get(pk=build.pk).state, 'failed')
+        self.assertEqual(BuildStats.objects.get().durations.count(','), 0)
+
+
+class CreateBuildsTests(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(slug='p1')
+        self.project.configurations.create(name='all')
+        self.project.configurations.create(name='master', branches=['master'])
+        self.project.configurations.create(name='dev', branches=['dev'])
+
+    def test_create_builds(self):
+        branches = ['master', 'dev', 'feature1', 'feature2']
+        # configurations + one INSERT per commit + builds INSERT + builds SELECT
+        with self.assertNumQueries(1 + len(branches) + 2):
+            builds = create_builds(self.project, branches)
+        self.assertEqual(Commit.objects.count(), 4)
+        self.assertEqual(Build.objects.count(), 6)
+        self.assertEqual(sorted((build.commit.branch, build.configuration.name) for build in builds), [
+            ('dev', 'all'), ('dev', 'dev'), ('feature1', 'all'), ('feature2', 'all'),
+            ('master', 'all'), ('master', 'master')
+        ])
+
+    def test_no_empty_commits(self):
+        self.project.configurations.exclude(name='dev').delete()
+        self.assertEqual(len(create_builds(self.project, ['master', 'dev'])), 1)
+        self.assertEqual(Commit.objects.get().branch, 'dev')
+
+    def test_coalesce(self):
+        self.project.configurations.filter(name='all').update(coalesce='pending')
+        self.project.configurations.filter(name='master').update(coalesce='all')
+        old_builds = create_builds(self.project, ['master', 'dev'])
+        active = Build.objects.get(commit__branch='master', configuration__name='master')
+        active.started = datetime.now()
+        active.save()
+
+        create_builds(self.project, ['master', 'dev'])
+        superseded = Build.objects.filter(pk__in=[build.pk for build in old_builds],
+                                          cancel_reason='superseded')
+        self.assertEqual(sorted((build.commit.branch, build.configuration.name, build.state)
+                                for build in superseded), [
+            ('dev', 'all', 'superseded'),
+            ('master', 'all', 'superseded'),
+            ('master', 'master', 'superseded'),
+        ])
+        self.assertEqual(Build.objects.get(pk=active.pk).finished, None)
+        # the 'dev' configuration doesn't coalesce
+        self.assertEqual(Build.objects.filter(cancel_reason=None).count(), 5)
+
+    def test_superseded_commits_are_deleted(self):
+        self.project.configurations.update(coalesce='pending')
+        old_builds = create_builds(self.project, ['master'])
+        create_builds(self.project, ['master'])
+        self.assertEqual(Commit.objects.count(), 1)
+        self.assertEqual(Build.objects.filter(pk__in=[build.pk for build in old_builds]).count(), 0)
+
+    def test_logs_of_superseded_commits_are_deleted(self):
+        self.project.configurations.exclude(name='all').delete()
+        self.project.configurations.update(coalesce='all')
+        build, = create_builds(self.project, ['master'])
+        build.started = datetime.now()
+        build.stdout.save_named('output')
+        create_builds(self.project, ['master'])
+        # aborted by the builder
+        build.finished = datetime.now()
+        build.cancel_reason = 'superseded'
+        finish_build(build)
+        self.assertFalse(Commit.objects.filter(pk=build.commit_id).exists())
+        self.assertFalse(default_storage.exists(build.stdout.name))
+
+    def test_matrix(self):
+        self.project.configurations.filter(name='master').update(matrix="A = 1, 2\nB = 3, 4")
+        builds = create_builds(self.project, ['master'])
+        self.assertEqual(sorted((build.configuration.name, build.matrix_cell) for build in builds), [
+            ('all', ''), ('master', 'A=1, B=3'), ('master', 'A=1, B=4'),
+            ('master', 'A=2, B=3'), ('master', 'A=2, B=4')
+        ])
+
+    def test_known_revisions(self):
+        builds = create_builds(self.project, OrderedDict([('master', 'c1'), ('dev', None)]))
+        self.assertEqual(sorted(set((build.commit.branch, build.commit.vcs_id) for build in builds)),
+                         [('dev', None), ('master', 'c1')])
+        # redelivered hook
+        self.assertEqual(len(create_builds(self.project, {'master': 'c1'})), 0)
+        self.assertEqual(len(create_builds(self.project, {'master': 'c2'})), 2)
+
+    def test_reuse_results(self):
+        self.project.configurations.update(reuse_results=True)
+        now = datetime.now()
+        Build.objects.filter(pk__in=[build.pk for build in create_builds(self.project, {'master': 'c1'})]) \
+                     .update(started=now, finished=now, was_successful=True)
+        builds = create_builds(self.project, {'feature': 'c1'})
+        self.assertEqual([(build.was_successful, bool(build.reused_from)) for build in builds],
+                         [(True, True)])
+        self.assertEqual(Commit.objects.get(branch='feature').was_successful, True)
+
+    def test_reuse_results_per_matrix_cell(self):
+        self.project.configurations.filter(name='all').update(reuse_results=True,
+                                                              matrix="DB = sqlite, mysql")
+        now = datetime.now()
+        for build in create_builds(self.project, {'master': 'c1'}):
+            Build.objects.filter(pk=build.pk).update(started=now, finished=now,
+                                                     was_successful=build.matrix_cell != 'DB=mysql')
+        builds = create_builds(self.project, {'feature': 'c1'})
+        self.assertEqual(sorted((build.matrix_cell, build.was_successful, bool(build.reused_from))
+                                for build in builds),
+                         [('DB=mysql', None, False), ('DB=sqlite', True, True)])
+
+    def test_superseded_builds_are_not_executed(self):
+        build = create_builds(self.project, ['feature'])[0]
+        Build.objects.filter(pk=build.pk).update(finished=datetime.now(),
+                                                 cancel_reason='superseded')
+        execute_build(build.pk, 'doesnotexist')
+        self.assertEqual(Build.objects.get(pk=build.pk).started, None)
+
+
+@override_settings(CI_MAX_CONCURRENT_BUILDS=None)
+class ScheduleBuildsTests(TestCase):
+    def setUp(self):
+        self.big = Project.objects.create(name='big', slug='big', important_branches=['master'])
+        self.small = Project.objects.create(name='small', slug='small')
+        for i in range(3):
+            self.big.configurations.create(name='big%d' % i)
+        self.small.configurations.create(name='small')
+
+    def get_claimed(self):
+        return sorted(Build.objects.get(pk=build['id']).configuration.name
+                      for build in claim_builds())
+
+    @override_settings(CI_MAX_CONCURRENT_BUILDS=0)
+    def test_release_stale_builds(self):
+        self.small.configurations.update(timeout=60)
+        create_builds(self.small, ['master', 'feature'])
+        create_builds(self.big, ['feature'])
+        long_ago = datetime.now() - timedelta(days=2)
+        recent = datetime.now() - timedelta(minutes=5)
+        builds = Build.objects.filter
+        builds(commit__branch='master').update(started=recent)
+        builds(commit__project=self.small, commit__branch='feature').update(started=long_ago)
+        builds(configuration__name='big0').update(queued=long_ago, worker='w1')
+        builds(configuration__name='big1').update(queued=recent)
+        builds(configuration__name='big2').update(started=long_ago + timedelta(hours=25))
+        self.assertEqual(release_stale_builds(), (1, 1))
+        self.assertEqual(sorted((build.configuration.name, build.commit.branch, build.state)
+                                for build in Build.objects.all()), [
+            ('big0', 'feature', 'pending'), ('big1', 'feature', 'pending'),
+            ('big2', 'feature', 'active'), ('small', 'feature', 'timed_out'),
+            ('small', 'master', 'active')
+        ])
+        self.assertEqual(builds(configuration__name='big0').get().worker, None)
+        self.assertEqual(Commit.objects.get(project=self.small, branch='feature').was_successful,
+                         False)
+
+    def test_priorities(self):
+        self.big.configurations.exclude(name='big0').delete()
+        create_builds(self.big, ['master', 'feature1'])
+        create_builds(self.big, ['feature2'])
+        self.assertEqual([build['commit__branch'] for _, build in
+                          get_build_queue(get_unfinished_builds())],
+                         ['master', 'feature2', 'feature1'])
+
+    def test_fair_share(self):
+        create_builds(self.big, ['master'])
+        Build.objects.filter(configuration__name='big0').update(started=datetime.now())
+        create_builds(self.small, ['master', 'feature'])
+        self.assertEqual([(running, build['commit__project']) for running, build in
+                          get_build_queue(get_unfinished_builds())], [
+            (0, self.small.pk), (1, self.big.pk), (1, self.small.pk), (2, self.big.pk)
+        ])
+
+    def test_project_limit(self):
+        Project.objects.filter(pk=self.big.pk).update(max_concurrent_builds=2)
+        create_builds(self.big, ['master'])
+        create_builds(self.small, ['master'])
+        self.assertEqual(self.get_claimed(), ['big0', 'big1', 'small'])
+        self.assertEqual(self.get_claimed(), [])
+        Build.objects.filter(configuration__name='big0').update(finished=datetime.now(),
+                                                                cancel_reason='cancelled')
+        self.assertEqual(self.get_claimed(), ['big2'])
+
+    @override_settings(CI_MAX_CONCURRENT_BUILDS=2)
+    def test_global_limit(self):
+        create_builds(self.big, ['master'])
+        create_builds(self.small, ['master'])
+        self.assertEqual(self.get_claimed(), ['big0', 'small'])
+        self.assertEqual(self.get_claimed(), [])
+
+    def test_configuration_limit(self):
+        self.big.configurations.filter(name='big0').update(max_concurrent_builds=1)
+        create_builds(self.big, ['master', 'feature'])
+        self.assertEqual(self.get_claimed(), ['big0', 'big1', 'big1', 'big2', 'big2'])
+
+    def test_locks(self):
+        self.big.configurations.filter(name__in=['big0', 'big1']).update(locks='db')
+        self.small.configurations.update(locks='db, cache')
+        create_builds(self.big, ['master'])
+        create_builds(self.small, ['master'])
+        self.assertEqual(self.get_claimed(), ['big0', 'big2'])
+        Build.objects.filter(configuration__name='big0').update(finished=datetime.now(),
+                                                                cancel_reason='cancelled')
+        self.assertEqual(self.get_claimed(), ['small'])
+
+    @override_settings(CI_WORKERS={'w1': {'cpus': 4, 'memory': 4096},
+                                   'w2': {'cpus': 2, 'memory': 1024}})
+    def test_placement(self):
+        self.big.configurations.filter(name='big0').update(cpus=3)
+        self.big.configurations.filter(name='big1').update(cpus=1, memory=2048)
+        self.big.configurations.filter(name='big2').update(cpus=2)
+        self.small.configurations.update(cpus=5)
+        create_builds(self.big, ['master'])
+        create_builds(self.small, ['master'])
+        claim_builds()
+        self.assertEqual(sorted(Build.objects.exclude(worker=None)
+                                .values_list('configuration__name', 'worker')),
+                         [('big0', 'w1'), ('big1', 'w1'), ('big2', 'w2')])
+
+
+class MaxConcurrentBuildsTests(TestCase):
+    def test_default(self):
+        self.assertEqual(get_max_concurrent_builds(), cpu_count())
+        with override_settings(CI_WORKERS={'w1': {'cpus': 4, 'memory': 4096},
+                                           'w2': {'cpus': 2, 'memory': 1024}}):
+            self.assertEqual(get_max_concurrent_builds(), 6)
+
+
+class ExecuteBuildsTests(BaseTransactionTestCase):
+    commits = [{'message': "Added build script",
+                'added': {'build.sh': 'echo -n $DB; sleep 0.5; test "$DB" != mysql'}}]
+
+    def setUp(self):
+        super(ExecuteBuildsTests, self).setUp()
+        self.clones = clones = []
+        class Builder(BuildDotShBuilder):
+            @staticmethod
+            def clone_repository(project, path):
+                clones.append(path)
+                return BuildDotShBuilder.clone_repository(project, path)
+        BUILDERS['sh'] = Builder
+        self.project.configurations.create(name='matrix', builder='sh',
+                                           matrix="DB = sqlite, postgres, mysql")
+        self.project.configurations.create(name='plain', builder='sh')
+
+    def tearDown(self):
+        super(ExecuteBuildsTests, self).tearDown()
+        del BUILDERS['sh']
+
+    def get_results(self):
+        return sorted(Build.objects.values_list('configuration__name', 'matrix_cell',
+                                                'was_successful'))
+
+    @override_settings(CI_MATRIX_PARALLELISM=3, CI_MAX_CONCURRENT_BUILDS=None)
+    def test_parallel(self):
+        build_branches(self.project, [default_branch])
+        # one clone per matrix
+        self.assertEqual(len(self.clones), 2)
+        self.assertEqual(self.get_results(), [
+            ('matrix', 'DB=mysql', False), ('matrix', 'DB=postgres', True),
+            ('matrix', 'DB=sqlite', True), ('plain', '', True)
+        ])
+        # run at the same time rather than one after another
+        finished = Build.objects.filter(configuration__name='matrix') \
+                                .values_list('finished', flat=True)
+        self.assertLess(max(finished) - min(finished), timedelta(seconds=0.5))
+        self.assertEqual(Commit.objects.get().was_successful, False)
+
+    @override_settings(CI_MATRIX_PARALLELISM=2, CI_MAX_CONCURRENT_BUILDS=None,
+                       CI_BATCH_COMMIT_BUILDS=True)
+    def test_batch(self):
+        build_branches(self.project, [default_branch])
+        self.assertEqual(len(self.clones), 1)
+        self.assertEqual(Build.objects.filter(finished=None).count(), 0)
+        self.assertEqual(Commit.objects.get().was_successful, False)
@@ -3,7 +3,7 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from vcs.nodes import FileNode
 from vcs.backends import get_repo
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from ci.models import Project
 from ci.plugins.base import CommandBasedBuilder
 
@@ -13,7 +13,7 @@ default_branch = 'master'
 class BuildDotShBuilder(CommandBasedBuilder):
     cmd = ['sh', 'build.sh']
 
-class BaseTestCase(TestCase):
+class RepositoryMixin(object):
     commits = [{'message': "Empty initial commit"}]
 
     def setUp(self):
@@ -43,3 +43,9 @@ class BaseTestCase(TestCase):
 
     def tearDown(self):
         rmtree(self.repo_path)
+
+class BaseTestCase(RepositoryMixin, TestCase):
+    pass
+
+class BaseTransactionTestCase(RepositoryMixin, TransactionTestCase):
+    """ For tests that access the database from several threads """
@@ -1,13 +1,18 @@
+import gzip
 import random
+from StringIO import StringIO
 from collections import OrderedDict, defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from BeautifulSoup import BeautifulSoup
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.sites.models import Site
 
-from ci.models import Project, Commit, Build
+from ci.models import Project, Commit, Build, BranchStatus, HookEvent
 from ci.plugins import BUILDERS, BUILD_HOOKS
 from ci.plugins.base import BuildHook
+from ci.tasks import process_hook_events
 from ci.tests.utils import BaseTestCase, VCS, default_branch, BuildDotShBuilder
 
 class TestBuildHook(BuildHook):
@@ -45,6 +50,67 @@ class BuildHookTests(BaseTestCase):
         self.assertEqual(Commit.objects.count(), 1)
         self.assertEqual(Build.objects.count(), 2)
         self.assertTrue(Commit.objects.get().was_successful)
+        status = BranchStatus.objects.get()
+        self.assertEqual(status.branch, default_branch)
+        self.assertEqual(status.latest_commit, Commit.objects.get())
+        self.assertEqual(status.latest_stable_commit, Commit.objects.get())
+        self.assertEqual((status.active_builds, status.pending_builds), (0, 0))
+
+    @override_settings(CI_ASYNC_HOOKS=True)
+    def test_async_hook(self):
+        self.assertEqual(self.client.get('/ci/p1/buildhooks/testhook/').status_code, 202)
+        self.assertEqual(HookEvent.objects.count(), 0)
+        self.assertEqual(Build.objects.count(), 2)
+        self.assertTrue(Commit.objects.get().was_successful)
+
+    @override_settings(CI_ASYNC_HOOKS=True)
+    def test_async_hook_404(self):
+        self.assert404(self.client.get('/ci/no-such-project/buildhooks/testhook/'))
+        self.assert404(self.client.get('/ci/p1/buildhooks/no-such-hook/'))
+        self.assertEqual(HookEvent.objects.count(), 0)
+
+    def test_hook_events_are_batched(self):
+        class Hook(TestBuildHook):
+            def get_changed_branches(self):
+                return self.request.GET.getlist('branch')
+        BUILD_HOOKS['testhook'] = Hook
+        self.commit({'branch': 'other'})
+        for query_string in ['branch=master', 'branch=other&branch=master']:
+            self.project.hook_events.create(hook_type='testhook', query_string=query_string)
+        process_hook_events()
+        self.assertEqual(HookEvent.objects.count(), 0)
+        self.assertEqual(sorted(Commit.objects.values_list('branch', flat=True)),
+                         ['master', 'other'])
+        self.assertEqual(Build.objects.count(), 4)
+
+    def test_stale_hook_events_are_reclaimed(self):
+        now = datetime.now()
+        for claimed in [None, now - timedelta(hours=1), now]:
+            self.project.hook_events.create(hook_type='testhook', claimed=claimed,
+                                            batch=claimed and 'dead')
+        process_hook_events()
+        self.assertEqual(list(HookEvent.objects.values_list('claimed', flat=True)), [now])
+        self.assertEqual(Commit.objects.count(), 1)
+
+    def test_failing_hook_events(self):
+        class Hook(TestBuildHook):
+            def get_changed_branches(self):
+                if self.request.GET.get('fail'):
+                    raise ValueError("bad request")
+                return [default_branch]
+        BUILD_HOOKS['testhook'] = Hook
+        other_project = Project.objects.create(name='p2', slug='p2')
+        other_project.hook_events.create(hook_type='testhook', query_string='fail=1')
+        self.project.hook_events.create(hook_type='testhook')
+        process_hook_events()
+        self.assertEqual(list(HookEvent.objects.values_list('project', 'attempts')),
+                         [(other_project.pk, 1)])
+        self.assertEqual(Commit.objects.get().project, self.project)
+        # retried right away, then dropped
+        with override_settings(CI_HOOK_CLAIM_TIMEOUT=-1):
+            process_hook_events()
+        self.assertEqual(HookEvent.objects.count(), 0)
+        self.assertEqual(Commit.objects.count(), 1)
 
     def test_commit_without_builds(self):
         self.project.configurations.all().delete()
@@ -119,6 +185,7 @@ class OverviewTests(TestCase):
             assert success is not None
             kwargs['was_successful'] = success
         commit.builds.create(**kwargs)
+        BranchStatus.refresh(commit.project, commit.branch)
 
     def _test_base(self, state, state_text):
         response = self.client.get(self.url)
@@ -191,6 +258,22 @@ class OverviewTests(TestCase):
         self.assertContains(response, "pending: 2")
 
 
+    def test_number_of_queries(self):
+        Site.objects.get_current()
+        # Project list + unfinished builds + build queue + build results
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+        for i in range(3, 10):
+            project = Project.objects.create(name='p%d' % i, slug='p%d' % i,
+                                             important_branches=['b1'] if i % 2 else None)
+            for branch in ['b1', 'b2', 'b3']:
+                commit = project.commits.create(branch=branch, vcs_id='c1', was_successful=True)
+                self.add_build(commit, done=True, success=True)
+                self.add_build(project.commits.create(branch=branch), started=False)
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+
+
 class ProjectDetailsTests(TestCase):
     # XXX show branches without builds (+ pending + active)
     url = '/ci/my-super-cool-project/'
@@ -225,7 +308,9 @@ class ProjectDetailsTests(TestCase):
         kwargs.setdefault('started', datetime.now())
         kwargs.setdefault('finished', datetime.now())
         config = self.project.configurations.get(name=config)
-        return commit.builds.create(configuration=config, **kwargs)
+        build = commit.builds.create(configuration=config, **kwargs)
+        BranchStatus.refresh(commit.project, commit.branch)
+        return build
 
     def assertBranchList(self, expected_branch_list=None, **kwargs):
         if expected_branch_list is None:
@@ -331,6 +416,24 @@ class ProjectDetailsTests(TestCase):
         ]})
 
 
+    def test_number_of_queries(self):
+        Site.objects.get_current()
+        # Project + build queue + branch statuses + unfinished commits + builds
+        # + configurations + build stats
+        with self.assertNumQueries(7):
+            self.client.get(self.url)
+        for branch in ['b1', 'b2', 'b3', 'b4']:
+            for i in range(3):
+                commit = self.project.commits.create(branch=branch, vcs_id='%s-%d' % (branch, i),
+                                                     was_successful=bool(i % 2))
+                self.add_build(commit, 'tests', was_successful=bool(i % 2))
+            unfinished = self.project.commits.create(branch=branch, vcs_id='%s-!done' % branch)
+            self.add_build(unfinished, 'tests', finished=None)
+            self.add_build(unfinished, 'docs', started=None, finished=None)
+        with self.assertNumQueries(7):
+            self.client.get(self.url)
+
+
 class CommitDetailsTests(TestCase):
     url = '/ci/testproject/builds/1/'
 
@@ -362,8 +465,112 @@ class CommitDetailsTests(TestCase):
             ('pending', 'pending')
         ])
 
+    def test_cancelled(self):
+        now = datetime.now()
+        self.add_build('good', {'started': now, 'finished': now, 'was_successful': True})
+        self.add_build('pending', {'finished': now, 'cancel_reason': 'cancelled'})
+        self.assertBuildList([('good', 'successful'), ('pending', 'cancelled')])
+
     def assertBuildList(self, l):
         html = self.client.get(self.url).content
         dom = BeautifulSoup(html)
         self.assertEqual(l, [(span.text, span['class'].split()[1])
                              for span in dom.findAll(None, 'build')])
+
+
+class BuildCancelTests(TestCase):
+    url = '/ci/testproject/builds/1/%d/cancel/'
+
+    def setUp(self):
+        self.project = Project.objects.create(slug='testproject')
+        self.commit = self.project.commits.create(branch='testbranch', vcs_id='testid')
+        configurations = self.project.configurations
+        self.builds = [self.commit.builds.create(configuration=configurations.create()),
+                       self.commit.builds.create(configuration=configurations.create(),
+                                                 started=datetime.now())]
+
+    def cancel(self, build):
+        response = self.client.post(self.url % build.pk)
+        self.assertEqual(response.status_code, 302)
+        return Build.objects.get(pk=build.pk)
+
+    def test_get(self):
+        self.assertEqual(self.client.get(self.url % 1).status_code, 405)
+
+    def test_404(self):
+        self.assertEqual(self.client.post(self.url % 3).status_code, 404)
+
+    def test_cancel_pending(self):
+        build = self.cancel(self.builds[0])
+        self.assertEqual(build.state, 'cancelled')
+        self.assertTrue(build.finished)
+        status = BranchStatus.objects.get(branch='testbranch')
+        self.assertEqual((status.active_builds, status.pending_builds), (1, 0))
+
+    def test_cancel_active(self):
+        # aborted by the builder, see `CommandBasedBuilder.stream_output`
+        build = self.cancel(self.builds[1])
+        self.assertEqual(build.cancel_reason, 'cancelled')
+        self.assertEqual(build.finished, None)
+
+    def test_cancel_all(self):
+        self.cancel(self.builds[1])
+        Build.objects.filter(pk=self.builds[1].pk).update(finished=datetime.now())
+        self.cancel(self.builds[0])
+        self.assertEqual(Commit.objects.get().was_successful, False)
+
+
+class BuildLogTests(TestCase):
+    url = '/ci/testproject/builds/1/1/stdout/'
+
+    def setUp(self):
+        self.project = Project.objects.create(slug='testproject')
+        commit = self.project.commits.create(branch='testbranch', vcs_id='testid')
+        self.build = commit.builds.create(configuration=self.project.configurations.create(),
+                                          started=datetime.now())
+        self.build.stdout.save_named('0123456789')
+
+    def assertLog(self, response, content, offset, state='active'):
+        self.assertEqual(response.content, content)
+        self.assertEqual(response['X-Log-Offset'], str(offset))
+        self.assertEqual(response['X-Build-State'], state)
+
+    def test_404(self):
+        self.assertEqual(self.client.get('/ci/testproject/builds/1/2/stdout/').status_code, 404)
+        self.assertEqual(self.client.get('/ci/testproject/builds/2/1/stdout/').status_code, 404)
+        self.assertEqual(self.client.get('/ci/testproject/builds/1/1/foo/').status_code, 404)
+
+    def test_no_log_yet(self):
+        response = self.client.get('/ci/testproject/builds/1/1/stderr/')
+        self.assertEqual(response.status_code, 200)
+        self.assertLog(response, '', 0)
+
+    def test_offset(self):
+        self.assertLog(self.client.get(self.url), '0123456789', 10)
+        self.assertLog(self.client.get(self.url, {'offset': 4}), '456789', 10)
+        self.assertLog(self.client.get(self.url, {'offset': 10}), '', 10)
+        self.assertEqual(self.client.get(self.url, {'offset': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'offset': -3}).status_code, 400)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=7-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 7-9/*')
+        self.assertLog(response, '789', 10)
+
+    def test_compressed(self):
+        self.build.stdout.compress()
+        self.assertTrue(self.build.stdout.compressed)
+        self.assertLog(self.client.get(self.url, {'offset': 4}), '456789', 10)
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.content)).read(), '0123456789')
+        self.assertEqual(response['X-Log-Offset'], '10')
+        self.assertLog(self.client.get(self.url), '0123456789', 10)
+
+    def test_wait_for_finished_build(self):
+        self.build.finished = datetime.now()
+        self.build.was_successful = True
+        self.build.save()
+        response = self.client.get(self.url, {'offset': 10, 'wait': 60})
+        self.assertLog(response, '', 10, state='successful')
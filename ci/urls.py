@@ -5,6 +5,13 @@ from ci.views import ProjectList, ProjectDetails, CommitDetails
 urlpatterns = patterns('ci.views',
     url('^$', ProjectList.as_view(), name='overview'),
     url('^(?P<slug>[\w-]+)/$', ProjectDetails.as_view(), name='project'),
+    url('^(?P<slug>[\w-]+)/stats\.json$', 'project_stats', name='project-stats'),
     url('^(?P<project_slug>[\w-]+)/builds/(?P<pk>[\w-]+)/$', CommitDetails.as_view(), name='commit'),
+    url('^(?P<project_slug>[\w-]+)/builds/(?P<commit_pk>\d+)/(?P<build_pk>\d+)/(?P<stream>stdout|stderr)/$',
+        'build_log', name='build-log'),
+    url('^(?P<project_slug>[\w-]+)/builds/(?P<commit_pk>\d+)/(?P<build_pk>\d+)/cancel/$',
+        'build_cancel', name='build-cancel'),
+    url('^(?P<project_slug>[\w-]+)/builds/(?P<commit_pk>\d+)/(?P<build_pk>\d+)/artifacts/(?P<path>.+)$',
+        'build_artifact', name='build-artifact'),
     url('^(?P<project_slug>[\w-]+)/buildhooks/(?P<hook_type>[\w-]+)/$', 'build_hook'),
 )
@@ -1,6 +1,15 @@
 class BuildFailed(Exception):
     pass
 
+class BuildCancelled(Exception):
+    def __init__(self, reason, message=None):
+        Exception.__init__(self, message or "build %s" % reason)
+        self.reason = reason
+
+class BuildTimedOut(BuildCancelled):
+    def __init__(self, message):
+        BuildCancelled.__init__(self, 'timed_out', message)
+
 def get_subclasses(supercls):
     for cls in supercls.__subclasses__():
         yield cls
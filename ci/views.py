@@ -1,14 +1,25 @@
-from operator import not_
-from collections import OrderedDict
+import re
+import json
+import time
+import mimetypes
+from datetime import datetime
+from collections import defaultdict, OrderedDict
 
-from django.http import HttpResponse, Http404
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.shortcuts import redirect
+from django.db.models import Count, Sum
 from django.shortcuts import get_object_or_404
 from django.views.generic import ListView, DetailView
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-from ci.models import Project, Commit, Build
+from ci.models import Project, Commit, Build, BranchStatus, Artifact, BuildStats
+from ci.artifacts import open_blob, iter_chunks
+from ci.stats import PERCENTILES, get_stats, get_eta
 from ci.plugins import BUILD_HOOKS
-from ci.tasks import execute_build
+from ci.tasks import build_branches, cancel_build, get_queue_positions, \
+                     process_hook_events
 
 
 def get_project_by_slug(slug):
@@ -20,26 +31,144 @@ def build_hook(request, project_slug, hook_type):
     project = get_project_by_slug(project_slug)
     if hook_type not in BUILD_HOOKS:
         raise Http404
-    hook = BUILD_HOOKS[hook_type](request)
 
-    branches = {branch: project.commits.create(branch=branch)
-                for branch in hook.get_changed_branches()}
-
-    configurations = project.configurations.all()
-    for branch, commit in branches.iteritems():
-        nbuilds = 0
-        for build_config in configurations:
-            if build_config.should_build_branch(branch):
-                nbuilds += 1
-                build = commit.builds.create(configuration=build_config)
-                execute_build.delay(build.id, build_config.builder)
-        if nbuilds < 1:
-            # Don't keep empty commits
-            commit.delete()
+    if getattr(settings, 'CI_ASYNC_HOOKS', False):
+        project.hook_events.create(hook_type=hook_type,
+                                   query_string=request.GET.urlencode(),
+                                   post_data=request.POST.urlencode())
+        process_hook_events.delay()
+        return HttpResponse(status=202)
 
+    hook = BUILD_HOOKS[hook_type](request)
+    build_branches(project, OrderedDict(hook.get_changed_revisions()))
     return HttpResponse()
 
 
+def parse_log_offset(request):
+    """
+    Returns the offset given as ``Range: bytes=<offset>-`` header or as
+    ``?offset=`` parameter and whether it was given as range.
+    """
+    match = re.match(r'^bytes=(\d+)-$', request.META.get('HTTP_RANGE', ''))
+    if match:
+        return int(match.group(1)), True
+    return int(request.GET.get('offset', 0)), False
+
+
+def read_log(build, stream, offset):
+    logfile = getattr(build, stream)
+    if not logfile:
+        return ''
+    try:
+        fobj = logfile.open_uncompressed()
+    except (IOError, OSError):
+        # compressed meanwhile; we'll see the new name in the next round
+        return ''
+    try:
+        fobj.seek(offset)
+        return fobj.read(getattr(settings, 'CI_LOG_CHUNK_SIZE', 1024 * 1024))
+    finally:
+        fobj.close()
+        logfile.close()
+
+
+def build_log(request, project_slug, commit_pk, build_pk, stream):
+    """
+    Serves the `stream` log of a (possibly still running) build starting at
+    a byte offset.  With ``?wait=<seconds>``, waits for new output to appear
+    (or the build to finish) before responding with an empty chunk.  The
+    offset to continue from is returned in the ``X-Log-Offset`` header.
+
+    Compressed logs are sent as they are (with ``Content-Encoding: gzip``)
+    if the whole log is requested and the client accepts gzip encoding.
+    """
+    build_qs = Build.objects.filter(commit__project__slug=project_slug,
+                                    commit__pk=commit_pk)
+    build = get_object_or_404(build_qs, pk=build_pk)
+    try:
+        offset, is_range = parse_log_offset(request)
+        wait = min(float(request.GET.get('wait', 0)),
+                   getattr(settings, 'CI_LOG_MAX_WAIT', 30))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if offset < 0:
+        return HttpResponseBadRequest()
+
+    logfile = getattr(build, stream)
+    if logfile and logfile.compressed and not offset and \
+            'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        size = logfile.get_uncompressed_size()
+        logfile.open('rb')
+        response = HttpResponse(iter_chunks(logfile), content_type='text/plain')
+        response['Content-Encoding'] = 'gzip'
+        response['X-Log-Offset'] = size
+        response['X-Build-State'] = build.state
+        return response
+
+    deadline = time.time() + wait
+    data = read_log(build, stream, offset)
+    while not data and not build.finished and time.time() < deadline:
+        time.sleep(getattr(settings, 'CI_LOG_POLL_INTERVAL', 0.5))
+        build = build_qs.get(pk=build_pk)
+        data = read_log(build, stream, offset)
+
+    response = HttpResponse(data, content_type='text/plain')
+    if is_range and data:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/*' % (offset, offset + len(data) - 1)
+    response['X-Log-Offset'] = offset + len(data)
+    response['X-Build-State'] = build.state
+    return response
+
+
+@require_POST
+def build_cancel(request, project_slug, commit_pk, build_pk):
+    build = get_object_or_404(Build.objects.select_related('commit__project'),
+                              commit__project__slug=project_slug,
+                              commit__pk=commit_pk, pk=build_pk)
+    cancel_build(build)
+    BranchStatus.refresh(build.commit.project, build.commit.branch)
+    return redirect(build.commit)
+
+
+def build_artifact(request, project_slug, commit_pk, build_pk, path):
+    """
+    Serves an artifact.  Compressed artifacts are served as they are stored if
+    the client accepts gzip encoding, and decompressed on the fly otherwise.
+    """
+    artifact = get_object_or_404(Artifact.objects.select_related('blob'),
+                                 build__commit__project__slug=project_slug,
+                                 build__commit__pk=commit_pk, build__pk=build_pk,
+                                 path=path)
+    blob = artifact.blob
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if blob.compressed and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        blob.file.open('rb')
+        response = HttpResponse(iter_chunks(blob.file), content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(iter_chunks(open_blob(blob)), content_type=content_type)
+        response['Content-Length'] = blob.size
+    return response
+
+
+def project_stats(request, slug):
+    """ Serves the build statistics of the project's configurations as JSON """
+    project = get_project_by_slug(slug)
+    stats = get_stats(project.configurations.all())
+    data = []
+    for config in project.configurations.order_by('name'):
+        config_stats = stats.get(config.pk, BuildStats())
+        data.append({
+            'configuration': config.name,
+            'builds': len(filter(None, config_stats.durations.split(','))),
+            'duration': {'p%d' % p: getattr(config_stats, 'duration_p%d' % p)
+                         for p in PERCENTILES},
+            'wait': {'p%d' % p: getattr(config_stats, 'wait_p%d' % p) for p in PERCENTILES},
+        })
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
 class ProjectList(ListView):
     model = Project
 
@@ -49,18 +178,49 @@ class ProjectList(ListView):
         return context
 
     def get_project_list(self):
-        for project in self.object_list:
-            unfinished_builds = {'active': project.get_active_builds().count(),
-                                 'pending': project.get_pending_builds().count()}
-            commit_pks = [c.pk for c in project.get_latest_branch_commits()]
-            success_values = Build.objects.filter(commit__pk__in=commit_pks) \
-                                          .values_list('was_successful', flat=True)
-            finished_builds = len(success_values)
-            failed_builds = len(filter(not_, success_values))
-            state = 'unknown' if not finished_builds else \
-                        ('failed' if failed_builds else 'successful')
+        # A fixed number of queries, regardless of the number of projects,
+        # branches and commits.
+        projects = list(self.object_list)
+        unfinished_counts = BranchStatus.objects.order_by().values('project') \
+                                        .annotate(active=Sum('active_builds'),
+                                                  pending=Sum('pending_builds'))
+        unfinished_counts = {row['project']: row for row in unfinished_counts}
+        queue_positions = get_queue_positions(lambda build: build['commit__project'])
+        finished_builds = defaultdict(int)
+        failed_builds = defaultdict(int)
+        important_branches = {project.pk: project.important_branches
+                              for project in projects}
+
+        for row in self.get_latest_branch_commit_results():
+            project_pk = row['commit__project']
+            if important_branches.get(project_pk) and \
+                    row['commit__branch'] not in important_branches[project_pk]:
+                continue
+            finished_builds[project_pk] += row['count']
+            if not row['was_successful']:
+                failed_builds[project_pk] += row['count']
+
+        for project in projects:
+            unfinished_builds = dict(unfinished_counts.get(project.pk, {}),
+                                     position=queue_positions.get(project.pk))
+            finished = finished_builds[project.pk]
+            failed = failed_builds[project.pk]
+            state = 'unknown' if not finished else \
+                        ('failed' if failed else 'successful')
 
-            yield project, state, unfinished_builds, finished_builds, failed_builds
+            yield project, state, unfinished_builds, finished, failed
+
+    def get_latest_branch_commit_results(self):
+        """
+        Returns the number of builds per project, branch and build result of
+        each branch's latest finished commit.
+        """
+        latest_commits = BranchStatus.objects.values('latest_commit')
+        # builds that were cancelled before they finished don't count
+        return Build.objects.filter(commit__in=latest_commits).order_by() \
+                            .exclude(was_successful=None) \
+                            .values('commit__project', 'commit__branch', 'was_successful') \
+                            .annotate(count=Count('id'))
 
 
 class ProjectDetails(DetailView):
@@ -68,21 +228,41 @@ class ProjectDetails(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(ProjectDetails, self).get_context_data(**kwargs)
-        context['commits'] = self.object.get_branch_commits()
+        positions = get_queue_positions(
+            lambda build: (build['commit__project'], build['commit__branch']))
+        queue_positions = {branch: position for (project_pk, branch), position
+                           in positions.iteritems() if project_pk == self.object.pk}
+        context['commits'] = self.add_etas(self.object.get_branch_commits(queue_positions))
         return context
 
+    def add_etas(self, branch_commits):
+        """ Adds when the branch's unfinished builds are expected to be done """
+        stats = get_stats(self.object.configurations.all())
+        now = datetime.now()
+        for latest, stable, unfinished_builds, unfinished_commits in branch_commits:
+            etas = [get_eta(build, commit, stats.get(build.configuration_id), now)
+                    for commit in unfinished_commits for build in commit.builds.all()
+                    if not build.finished]
+            if etas and None not in etas:
+                unfinished_builds['eta'] = max(etas)
+            yield latest, stable, unfinished_builds, unfinished_commits
+
 
 class CommitDetails(DetailView):
     model = Commit
 
     def get_context_data(self, **kwargs):
         context = super(CommitDetails, self).get_context_data(**kwargs)
-        # TODO
-        assert context['object'].vcs_id
         context['builds'] = self.get_builds_grouped_by_state()
         return context
 
     def get_builds_grouped_by_state(self):
-        state_order = ['failed', 'successful', 'active', 'pending']
-        return sorted(self.object.builds.all(),
+        state_order = ['failed', 'timed_out', 'successful', 'active', 'pending',
+                       'cancelled', 'superseded']
+        builds = list(self.object.builds.select_related('reused_from__commit__project')
+                                        .prefetch_related('artifacts'))
+        stats = get_stats(set(build.configuration_id for build in builds))
+        for build in builds:
+            build.eta = get_eta(build, self.object, stats.get(build.configuration_id))
+        return sorted(builds,
                       key=lambda build: state_order.index(build.state))
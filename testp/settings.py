@@ -18,7 +18,7 @@ INSTALLED_APPS = [
     'ci',
 ]
 
-TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner'
+TEST_RUNNER = 'ci.tests.runner.TestSuiteRunner'
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 
 CI_PLUGINS = ['ci.plugins.defaultplugin', 'ci.plugins.github']